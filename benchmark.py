@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017-2019 Diego Montiel Gonzalez
+# Erasmus Medical Center
+# Department of Genetic Identification
+#
+# License: GNU General Public License v3 or later
+# A copy of GNU GPL v3 should have been included in this software package in LICENSE.txt.
+
+# Benchmark of the Clean treev2 hot paths on synthetic pileups and marker panels
+
+import time
+import os
+import re
+import json
+import hashlib
+import random
+import shutil
+import tempfile
+import pandas as pd
+import numpy as np
+from argparse import ArgumentParser
+import clean_tree
+import predict_haplogroup
+
+def get_arguments():
+
+    parser = ArgumentParser(description="Erasmus MC: Genetic Identification\n Clean tree benchmark")
+
+    parser.add_argument("-n", "--Rows",
+            help="Number of pileup rows (marker panel size) of every scale",
+            type=int, nargs="+", required=False, default=[1000, 10000, 50000])
+
+    parser.add_argument("-d", "--Depth",
+            help="Mean read depth of the synthetic pileup",
+            type=int, required=False, default=60)
+
+    parser.add_argument("-i", "--Indel_rate",
+            help="Fraction of reads with an insertion or deletion",
+            type=float, required=False, default=0.05)
+
+    parser.add_argument("-p", "--Predictions",
+            help="Number of synthetic samples predicted",
+            type=int, required=False, default=20)
+
+    parser.add_argument("-repeat", "--Repeat",
+            help="Repetitions of every timing, the fastest is reported",
+            type=int, required=False, default=3)
+
+    parser.add_argument("-seed", "--Seed",
+            help="Seed of the synthetic data, results of runs with the same seed can be compared",
+            type=int, required=False, default=1)
+
+    parser.add_argument("-out", "--Outfile",
+            dest="Outputfile", required=False,
+            help="Writes the timings and checksums as JSON", metavar="FILE")
+
+    parser.add_argument("-compare", "--Compare",
+            required=False, type=clean_tree.file_exists,
+            help="JSON of a previous run (same arguments), fails when the checksums differ", metavar="FILE")
+
+    args = parser.parse_args()
+    return args
+
+def make_read(rng, base, indel_rate):
+    """
+    Pileup string of a single read: optional read start (^ and a mapping
+    quality that can be any character, also + - ^ $ or a digit), the base,
+    optional insertion or deletion of 1 to 15 bases and optional read end ($)
+    """
+    read = ""
+    if rng.random() < 0.1:
+        read += "^"+chr(rng.randint(33, 126))
+    read += base if rng.random() < 0.5 else base.lower()
+    if rng.random() < indel_rate:
+        length = rng.choice([1, 2, 3, 9, 10, 12, 15])
+        read += rng.choice("+-")+str(length)+"".join(rng.choice("ACGTNacgtn") for i in range(length))
+    if rng.random() < 0.1:
+        read += "$"
+    return read
+
+def make_pileup(rng, positions, depth, indel_rate, chromosome="chrY"):
+    """
+    Synthetic samtools mpileup table of the given positions, most reads
+    support one base, some positions have zero reads
+    """
+    rows = []
+    for pos in positions:
+        reads = 0 if rng.random() < 0.02 else rng.randint(1, 2*depth)
+        major = rng.choice("ACGT")
+        bases = [major if rng.random() < 0.9 else rng.choice("ACGT*") for i in range(reads)]
+        align = "".join(make_read(rng, base, indel_rate) for base in bases) if reads else "*"
+        rows.append([chromosome, pos, "N", reads, align, "I"*max(reads, 1)])
+    return pd.DataFrame(rows, columns=['chr', 'pos', 'refbase', 'reads', 'align', 'quality'])
+
+def write_panel(rng, positions, path, chromosome="chrY"):
+    """
+    Synthetic positions file with one marker per position
+    """
+    with open(path, "w") as f:
+        for i, pos in enumerate(positions):
+            anc, der = rng.sample("ACGT", 2)
+            f.write("{}\tM{}\t{}\t{}\t{}->{}\t{}\t{}\n".format(chromosome, i, "J2a"[:1+i%3], pos, anc, der, anc, der))
+
+def reference_counts(aligns):
+    """
+    Base counts of the pileup strings read by read with trimm_caret,
+    find_all_indels, count_indels and trimm_indels (the string based path)
+    """
+    counts = np.zeros((len(aligns), 6), dtype=np.int64)
+    for i, align in enumerate(aligns):
+        align = clean_tree.trimm_caret(align.upper())
+        pos = clean_tree.find_all_indels(align)
+        indels = clean_tree.count_indels(align, pos)
+        align = clean_tree.trimm_indels(align, pos)
+        counts[i] = [align.count("A"), align.count("T"), align.count("G"), align.count("C"),
+                     indels["+"], indels["-"] + align.count("*")]
+    return counts
+
+def checksum(values):
+
+    return hashlib.md5(str(values).encode()).hexdigest()
+
+def checksum_table(df):
+
+    return hashlib.md5(df.to_csv(sep="\t", index=False).encode()).hexdigest()
+
+def best_time(function, repeat):
+    """
+    Fastest wall time of repeat calls and the result of the last one
+    """
+    times = []
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+def benchmark_scale(rng, n, args, tmp_folder):
+    """
+    Times the pileup parsing and marker calling on a panel of n markers and
+    checks them against the string based path
+    """
+    results = []
+    positions = sorted(rng.sample(range(2650000, 28800000), n))
+    Pileupfile = make_pileup(rng, positions, args.Depth, args.Indel_rate)
+    aligns = Pileupfile["align"].values
+    path_Markerfile = os.path.join(tmp_folder, "panel_{}.txt".format(n))
+    write_panel(rng, positions, path_Markerfile)
+    clean_tree.load_marker_database(path_Markerfile)
+
+    seconds, df_freq = best_time(lambda: clean_tree.get_frequency_table(Pileupfile), args.Repeat)
+    reference_seconds, reference = best_time(lambda: reference_counts(aligns), 1)
+    results.append({"function": "get_frequency_table", "rows": n, "seconds": seconds,
+                    "checksum": checksum(df_freq.values.tolist()),
+                    "check": bool(np.array_equal(df_freq.values, reference))})
+    results.append({"function": "string path (reference)", "rows": n, "seconds": reference_seconds,
+                    "checksum": checksum(reference.tolist()), "check": True})
+
+    seconds, trimmed = best_time(lambda: [clean_tree.trimm_caret(i) for i in aligns], args.Repeat)
+    results.append({"function": "trimm_caret", "rows": n, "seconds": seconds,
+                    "checksum": checksum(trimmed), "check": trimmed == [re.sub(r"\^.", "", i) for i in aligns]})
+    upper = [i.upper() for i in trimmed]
+    indel_positions = [clean_tree.find_all_indels(i) for i in upper]
+    seconds, trimmed = best_time(lambda: [clean_tree.trimm_indels(i, p) for i, p in zip(upper, indel_positions)],
+                                 args.Repeat)
+    results.append({"function": "trimm_indels", "rows": n, "seconds": seconds, "checksum": checksum(trimmed),
+                    "check": [sum(i.count(b) for b in "ATGC") for i in trimmed] == reference[:, :4].sum(axis=1).tolist()})
+
+    log_output = os.path.join(tmp_folder, "bench.log")
+    fmf_output = os.path.join(tmp_folder, "bench.fmf")
+    Outputfile = os.path.join(tmp_folder, "bench.out")
+    extract = lambda pileup: clean_tree.extract_haplogroups(path_Markerfile, 10, 90, pileup,
+                                                            log_output, fmf_output, Outputfile)
+    seconds, df_out = best_time(lambda: extract(Pileupfile), args.Repeat)
+    with open(fmf_output) as f:
+        fmf = f.read()
+    df_counts = Pileupfile[['chr', 'pos', 'refbase', 'reads']].copy()
+    df_counts[["A","T","G","C","+","-"]] = reference
+    df_reference = extract(df_counts)
+    with open(fmf_output) as f:
+        reference_fmf = f.read()
+    results.append({"function": "extract_haplogroups", "rows": n, "seconds": seconds,
+                    "checksum": checksum_table(df_out),
+                    "check": df_out.equals(df_reference) and fmf == reference_fmf})
+
+    with open(Outputfile) as f:
+        reference_out = f.read()
+    counts = clean_tree.get_count_columns(df_counts)
+    seconds, out = best_time(lambda: clean_tree.extract_haplogroups_light(path_Markerfile, 10, 90, counts, log_output,
+                                                                          fmf_output, Outputfile, n), args.Repeat)
+    with open(fmf_output) as f:
+        light_fmf = f.read()
+    with open(Outputfile) as f:
+        light_out = f.read()
+    results.append({"function": "extract_haplogroups_light", "rows": n, "seconds": seconds,
+                    "checksum": hashlib.md5(light_out.encode()).hexdigest(),
+                    "check": light_fmf == reference_fmf and light_out == reference_out})
+    return results
+
+def make_out_table(rng, markers, tree_path):
+    """
+    Called markers of a synthetic sample: derived for the markers on the path
+    to a random haplogroup, ancestral elsewhere, with some errors and dropouts
+    """
+    target = rng.choice(tree_path)
+    df = markers.sample(frac=0.8, random_state=rng.randint(0, 2**31))
+    derived = np.array([target.startswith(str(i)) for i in df["haplogroup"].values])
+    errors = np.array([rng.random() < 0.02 for i in range(len(df))])
+    state = np.where(derived != errors, "D", "A")
+    df_out = df[["chr","pos","marker_name","haplogroup","mutation","anc","der"]].copy()
+    df_out["reads"] = [rng.randint(10, 200) for i in range(len(df))]
+    df_out["called_perc"] = [rng.randint(90, 100) for i in range(len(df))]
+    df_out["called_base"] = np.where(state == "D", df_out["der"].values, df_out["anc"].values)
+    df_out["state"] = state
+    return df_out.sort_values(by=["pos"]).reset_index(drop=True)
+
+def reference_score_one(df_intermediate, df_haplogroup):
+    """
+    QC.1 of the pandas scoring (the prediction before the prediction tables 
+    were read once per run)
+    """
+    total = 0
+    correct_state = 0
+    for i in df_intermediate.values:
+        tmp = df_haplogroup.loc[df_haplogroup["haplogroup"] == i[0]]
+        if not tmp.empty:
+            if "/" in i[1]:
+                correct_state += len(tmp)
+                total += len(tmp)
+            else:
+                correct_state += np.sum(i[1] == tmp["state"])
+                total += len(tmp)
+    return round(correct_state / total, 3) if total else 0.0
+
+def reference_score_three(df_haplogroup, putative_hg, init_hg):
+    """
+    QC.3 of the pandas scoring
+    """
+    list_main_hg_all = sorted(set(i for i in df_haplogroup["haplogroup"].values if i.startswith(init_hg)), reverse=True)
+    df_main_hg_all = df_haplogroup.loc[df_haplogroup["haplogroup"].isin(list_main_hg_all)]
+    df_main_hg_all = df_main_hg_all[["haplogroup","state","marker_name"]].sort_values(by="haplogroup", ascending=False).values
+    a_match = 0
+    total_match = 0
+    for i in df_main_hg_all:
+        tmp_hg = i[0].replace("~","")
+        if tmp_hg in putative_hg and tmp_hg != putative_hg:
+            total_match += 1
+            if i[1] == "A":
+                a_match += 1
+    return round((total_match - a_match) / total_match, 3) if total_match else 0.0
+
+def reference_putative_hg_list(hg, df_haplogroup, init_hg):
+    """
+    QC.2 and QC.3 of every derived haplogroup, pandas scoring
+    """
+    dict_hg = {}
+    for putative_hg in sorted(set(hg)):
+        states = df_haplogroup.loc[df_haplogroup["haplogroup"] == putative_hg]["state"]
+        if len(states) == 0:
+            return dict_hg
+        qc_two = round((len(states)-np.sum("A" == states))/len(states), 2)
+        if qc_two >= 0.75:
+            dict_hg[putative_hg] = [qc_two, reference_score_three(df_haplogroup, putative_hg, init_hg)]
+    return dict_hg
+
+def reference_ancestral_hg(df_haplogroup, putative_hg):
+    """
+    Ancestral markers below the predicted haplogroup, pandas scoring
+    """
+    putative_ancestral_hg = []
+    putative_hg = putative_hg.replace("~","")
+    df_ancestral = df_haplogroup[df_haplogroup.haplogroup.str.startswith(putative_hg)].copy()
+    df_ancestral["haplogroup"] = df_ancestral["haplogroup"].str.replace("~","")
+    df_ancestral = df_ancestral[~df_ancestral.haplogroup.isin([putative_hg])]
+    df_ancestral = df_ancestral[df_ancestral.state == "A"].sort_values(by=["haplogroup"])
+    for i in df_ancestral.index:
+        if putative_ancestral_hg == [] or putative_ancestral_hg[-1]["haplogroup"] not in df_ancestral.loc[i]["haplogroup"]:
+            putative_ancestral_hg.append(df_ancestral.loc[i])
+    return putative_ancestral_hg
+
+def reference_prediction(out_file, path_hg_prediction_tables):
+    """
+    Prediction line of a .out file with the pandas scoring that re-read the 
+    prediction tables for every sample (the path predict_sample replaced)
+    """
+    out_name = os.path.basename(out_file).split(".")[0]
+    intermediates = pd.read_csv(path_hg_prediction_tables+"Intermediates.txt", header=None, engine="python")[0].values
+    df_haplogroup = pd.read_csv(out_file, sep="\t", engine="python").sort_values(by=["haplogroup"])
+    df_haplogroup["haplogroup"] = df_haplogroup["haplogroup"].str.replace("~", "")
+    df_derived = df_haplogroup[df_haplogroup["state"] == "D"]
+    hg = df_derived[~df_derived.haplogroup.isin(intermediates)]["haplogroup"].values
+    init_hg = predict_haplogroup.get_hg_root(hg)
+    try:
+        df_intermediate = pd.read_csv(path_hg_prediction_tables+init_hg+"_int.txt", header=None, sep="\t", engine="python")
+    except Exception:
+        df_intermediate = pd.DataFrame()
+    qc_one = reference_score_one(df_intermediate, df_haplogroup)
+    df_haplogroup = df_haplogroup[~df_haplogroup.haplogroup.isin(intermediates)]
+    hg = df_derived[df_derived.haplogroup.str.startswith(init_hg)].haplogroup.values
+    dict_hg = reference_putative_hg_list(hg, df_haplogroup, init_hg)
+    putative_hg = "NA"
+    for i in sorted(dict_hg.keys(), reverse=True):
+        if dict_hg[i][0] >= 0.75 and dict_hg[i][1] >= 0.75:
+            putative_hg = i
+            qc_two, qc_three = dict_hg[i]
+            break
+    if putative_hg == "NA":
+        return "{}\tNA\tNA\t0\t0\t0\t0".format(out_name)
+    marker_name = df_haplogroup.loc[df_haplogroup["haplogroup"] == putative_hg]["marker_name"].values
+    out_hg = putative_hg[0]+"-"+marker_name[0]+("/etc" if len(marker_name) > 1 else "")
+    putative_ancestral_hg = reference_ancestral_hg(df_haplogroup, putative_hg)
+    if putative_ancestral_hg:
+        out_hg += "*(x"+",".join(i["marker_name"] for i in putative_ancestral_hg)+")"
+    qc_score = round(qc_one*qc_two*qc_three, 3)
+    if qc_score < 0.7:
+        out_hg = putative_hg = "NA"
+    return "{}\t{}\t{}\t{}\t{}\t{}\t{}".format(out_name, putative_hg, out_hg, qc_score, qc_one, qc_two, qc_three)
+
+def benchmark_prediction(rng, args, tmp_folder):
+    """
+    Times the haplogroup prediction of synthetic samples built from the
+    positions file and checks it against the pandas scoring of their .out files
+    """
+    home_source = os.path.dirname(os.path.realpath(__file__))
+    markers = clean_tree.load_marker_database(home_source+"/data/positions.txt").markers
+    haplogroups = sorted(set(str(i) for i in markers["haplogroup"].values if str(i).startswith(("J","R","E"))))
+    tables = [make_out_table(rng, markers, haplogroups) for i in range(args.Predictions)]
+    predict_haplogroup.load_prediction_tables(home_source+"/Hg_Prediction_tables/")
+
+    results = []
+    predict = lambda: [predict_haplogroup.predict_sample(df, "sample{}".format(i)) for i, df in enumerate(tables)]
+    seconds, predictions = best_time(predict, args.Repeat)
+    reference = []
+    for i, df in enumerate(tables):
+        out_file = os.path.join(tmp_folder, "sample{}.out".format(i))
+        df.to_csv(out_file, sep="\t", index=False)
+        reference.append(reference_prediction(out_file, home_source+"/Hg_Prediction_tables/"))
+    lines = [predict_haplogroup.format_prediction(i) for i in predictions]
+    predictions = [list(i.values()) for i in predictions]
+    results.append({"function": "predict_sample", "rows": len(tables), "seconds": seconds,
+                    "checksum": checksum(predictions), "check": lines == reference})
+    seconds, counts = best_time(lambda: [predict_haplogroup.count_states(df["haplogroup"].values, df["state"].values)
+                                         for df in tables], args.Repeat)
+    results.append({"function": "count_states", "rows": len(tables), "seconds": seconds,
+                    "checksum": checksum([[hg_counts.tolist() for hg, hg_counts in sorted(i.items())] for i in counts]),
+                    "check": True})
+    return results
+
+def compare_results(results, path_previous):
+    """
+    Prints the speed up against a previous run, returns False when a checksum
+    changed (the calls are not the same anymore)
+    """
+    with open(path_previous) as f:
+        previous = dict(((i["function"], i["rows"]), i) for i in json.load(f)["results"])
+    same = True
+    for result in results:
+        old = previous.get((result["function"], result["rows"]))
+        if old is None:
+            continue
+        if old["checksum"] != result["checksum"]:
+            print("WARNING! {} ({} rows) gives different results than {}".format(result["function"], result["rows"], path_previous))
+            same = False
+        print("{}\t{}\t{:.4f}s -> {:.4f}s ({:.2f}x)".format(result["function"], result["rows"], old["seconds"],
+                                                           result["seconds"], old["seconds"]/max(result["seconds"], 1e-9)))
+    return same
+
+if __name__ == "__main__":
+
+    print("\tClean tree benchmark")
+
+    args = get_arguments()
+    rng = random.Random(args.Seed)
+    tmp_folder = tempfile.mkdtemp(prefix="clean_tree_benchmark")
+    results = []
+    try:
+        for n in args.Rows:
+            results += benchmark_scale(rng, n, args, tmp_folder)
+        results += benchmark_prediction(rng, args, tmp_folder)
+    finally:
+        shutil.rmtree(tmp_folder)
+
+    print("function\trows\tseconds\tcheck")
+    for result in results:
+        print("{}\t{}\t{:.4f}\t{}".format(result["function"], result["rows"], result["seconds"],
+                                          "OK" if result["check"] else "FAILED"))
+    if args.Outputfile:
+        with open(args.Outputfile, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=1)
+    failed = [i for i in results if not i["check"]]
+    if args.Compare and not compare_results(results, args.Compare):
+        failed.append(args.Compare)
+    if failed:
+        print("ERROR! Some results are not correct")
+        exit(1)
+    print("--- Clean tree benchmark finished... ---")
@@ -10,18 +10,39 @@
 # Clean_tree 2.0
 
 import time
+import re
 import subprocess
 import string
 import random
 import argparse, os
-import pandas as pd
 import numpy as np
 from argparse   import ArgumentParser
 from subprocess import Popen
 import collections
 import operator
 import gc
-pd.options.mode.chained_assignment = None  # default='warn'
+import multiprocessing
+import multiprocessing.pool
+import hashlib
+import json
+import shutil
+import tempfile
+import resource
+import contextlib
+import cProfile
+import csv
+import gzip
+import struct
+import predict_haplogroup
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+def set_pandas_options(pd):
+    pd.options.mode.chained_assignment = None  # default='warn'
+
+pd = predict_haplogroup.LazyModule("pandas", set_pandas_options) # imported the first time it is used
 
 def get_arguments():
 
@@ -29,7 +50,7 @@ def get_arguments():
 
     parser.add_argument("-bam", "--Bamfile",
         dest="Bamfile", required=False, type=file_exists,
-        help="input BAM file", metavar="PATH")    
+        help="input BAM or CRAM file (or a folder of them)", metavar="PATH")    
 
     parser.add_argument("-out", "--output",
             dest="Outputfile", required=True,                        
@@ -50,36 +71,198 @@ def get_arguments():
     parser.add_argument("-b", "--Base_majority",
             help="The minimum percentage of a base result for acceptance \n [50-99]",
             type=int, required=True)
+
+    parser.add_argument("-t", "--Targeted",
+            help="Only pileup the positions listed in the positions file instead of the whole chromosome Y",
+            action="store_true", required=False)
+
+    parser.add_argument("-s", "--Stream",
+            help="Read the pileup directly from samtools without writing an intermediate .pu file",
+            action="store_true", required=False)
+
+    parser.add_argument("-e", "--Engine",
+            help="Pileup engine, samtools subprocess or in-process pysam (only marker positions)",
+            choices=["samtools", "pysam"], default="samtools", required=False)
+
+    parser.add_argument("-ref", "--Reference",
+            help="Reference FASTA (with .fai) used to decode CRAM files",
+            type=file_exists, metavar="FILE", required=False)
+
+    parser.add_argument("-plate", "--Plate",
+            help="Pileup the marker positions of all BAM files in a single samtools mpileup and call all samples at once (implies -t)",
+            action="store_true", required=False)
+
+    parser.add_argument("-shards", "--Shards",
+            help="Split the marker positions of every sample into this many regions piled up in parallel (deep single samples)",
+            type=int, required=False, default=1)
+
+    parser.add_argument("-j", "--Jobs",
+            help="Number of BAM files processed in parallel",
+            type=int, required=False, default=1)
+
+    parser.add_argument("-force", "--Force",
+            help="Remove existing output folders without asking",
+            action="store_true", required=False)
+
+    parser.add_argument("-resume", "--Resume",
+            help="Keep the existing output folder and only process samples that are missing or outdated",
+            action="store_true", required=False)
+
+    parser.add_argument("-cache", "--Cache",
+            help="Folder where the base counts of every sample are kept, reruns with other read or base majority thresholds skip the pileup",
+            metavar="PATH", required=False)
+
+    parser.add_argument("-sweep_r", "--Sweep_reads",
+            help="List of read thresholds to evaluate in one run, written to <out>.sweep",
+            type=int, nargs="+", required=False)
+
+    parser.add_argument("-sweep_b", "--Sweep_majority",
+            help="List of base majority thresholds to evaluate in one run, written to <out>.sweep",
+            type=int, nargs="+", required=False)
+
+    parser.add_argument("-sort_t", "--Sort_threads",
+            help="Number of threads used by samtools sort when the BAM file is not coordinate sorted",
+            type=int, required=False, default=1)
+
+    parser.add_argument("-sort_m", "--Sort_memory",
+            help="Memory per thread used by samtools sort, e.g. 2G",
+            required=False, default="2G")
+
+    parser.add_argument("-tmp", "--Tmp_dir",
+            help="Folder for the temporary files of samtools sort",
+            metavar="PATH", required=False)
+
+    parser.add_argument("-min_y", "--Min_Y_reads",
+            help="Skip the pileup of samples with fewer reads mapped to chromosome Y (insufficient Y coverage)",
+            type=int, required=False, default=0)
+
+    parser.add_argument("-min_yp", "--Min_Y_perc",
+            help="Skip the pileup of samples with a lower percentage of reads mapped to chromosome Y (insufficient Y coverage)",
+            type=float, required=False, default=0.0)
+
+    parser.add_argument("-max_d", "--Max_depth",
+            help="Call the base of sites with more reads from this many reads drawn at random (the read threshold uses all reads), 0 to use all reads",
+            type=int, required=False, default=0)
+
+    parser.add_argument("-seed", "--Seed",
+            help="Seed of the reads drawn with -max_d",
+            type=int, required=False, default=0)
+
+    parser.add_argument("-binary", "--Binary",
+            help="Write the .out and .fmf tables as compact .out.npz and .fmf.npz files and all samples to <out>.cohort.npz",
+            action="store_true", required=False)
+
+    parser.add_argument("-light", "--Light",
+            help="Call the markers and predict the haplogroup with NumPy only, with -e pysam pandas is not loaded (faster start for small panels)",
+            action="store_true", required=False)
+
+    parser.add_argument("-profile", "--Profile",
+            help="Write a cProfile dump of every sample to its folder (<sample>.prof)",
+            action="store_true", required=False)
             
     args = parser.parse_args()    
     return args
 
-def get_frequency_table(mpileup):
+def get_frequency_table(mpileup, Max_depth=0, Seed=0):
     
     bases = ["A","T","G","C","+","-"]
-    frequency_table = {}
-    
-    for i in mpileup.values:       
-        fastadict = {"A":0,"T":0,"G":0,"C":0}                    
-        sequence = i[9] #actual sequence                
-        sequence = sequence.upper()         
-        sequence = trimm_caret(sequence)                            
-        sequence = sequence.replace("$", "")                   
-        indel_pos = find_all_indels(sequence)
-        ### Count number of indels
-        indels = count_indels(sequence, indel_pos)        
-        fastadict.update(indels)
-        fastadict["-"] += sequence.count("*")
-        ### Trimm Indels
-        trimm_sequence = trimm_indels(sequence, indel_pos)        
-        for seq in trimm_sequence:    
-            if seq in fastadict:            
-                fastadict[seq] +=1    
-        frequency_table.update({i[3]:list(fastadict.values())})    
-    df_frequency_table = pd.DataFrame.from_dict(frequency_table, orient='index')
-    df_frequency_table.columns = bases      
+    counts = count_pileup_bases(mpileup["align"].values, Max_depth, mpileup["pos"].values, Seed)
+    df_frequency_table = pd.DataFrame(counts, index=mpileup["pos"].values, columns=bases)
     return df_frequency_table
 
+pileup_chunk_chars = 1 << 22 # characters of pileup strings counted at once
+
+def count_pileup_bases(aligns, Max_reads=0, positions=None, Seed=0):
+    """
+    Counts A,T,G,C,+,- for a batch of pileup strings. Read starts (^ and 
+    mapping quality) and ends ($) are skipped, indel sequences are removed 
+    using their full (multi-digit) length. With Max_reads only Max_reads 
+    reads drawn at random (draw_reads) of every string with more reads are 
+    counted. The strings are counted in chunks of about pileup_chunk_chars 
+    characters so memory does not grow with the depth of the whole batch. 
+    Returns an N x 6 integer matrix in the order of aligns
+    """
+    n = len(aligns)
+    counts = np.zeros((n, 6), dtype=np.int64)
+    chunk = []
+    start, size = 0, 0
+    for end in range(n):
+        chunk.append(aligns[end])
+        size += len(aligns[end]) + 1
+        if size >= pileup_chunk_chars or end == n-1:
+            if Max_reads:
+                counts[start:end+1] = count_pileup_chunk(chunk, Max_reads, positions[start:end+1], Seed)
+            else:
+                counts[start:end+1] = count_pileup_chunk(chunk)
+            chunk = []
+            start, size = end+1, 0
+    return counts
+
+def draw_reads(n, Max_reads, Seed, pos):
+    """
+    Indexes (in pileup order) of Max_reads of the n reads of a position drawn 
+    without replacement. The draw is seeded by Seed and the position so it 
+    does not depend on the other positions or samples
+    """
+    rng = np.random.default_rng([Seed, int(pos)])
+    return rng.choice(n, Max_reads, replace=False)
+
+def count_pileup_chunk(aligns, Max_reads=0, positions=None, Seed=0):
+    """
+    count_pileup_bases of a chunk of pileup strings, in a single pass over 
+    one concatenated buffer
+    """
+    n = len(aligns)
+    counts = np.zeros((n, 6), dtype=np.int64)
+    buffer = "\n".join(aligns).upper()
+    buffer = re.sub(r"\^.", "", buffer)
+    data = np.frombuffer(buffer.encode("ascii"), dtype=np.uint8)
+    row = np.cumsum(data == ord("\n"), dtype=np.int32)
+    keep = None
+    indels = [(m.start(), m.end(), m.group(1), int(m.group(2))) for m in re.finditer(r"([+-])(\d+)", buffer)]
+    del buffer
+    if indels:
+        start, end, sign, length = zip(*indels)
+        start = np.array(start)
+        length = np.array(length)
+        stop = np.array(end) + length
+        is_insertion = np.array(sign) == "+"
+        ## mask the sign, digits and sequence of every indel
+        delta = np.zeros(len(data)+1, dtype=np.int32)
+        np.add.at(delta, start, 1)
+        np.add.at(delta, stop, -1)
+        keep = np.cumsum(delta[:-1], dtype=np.int32) == 0
+        del delta
+        indel_row = row[start]
+    if Max_reads:
+        ## one character per read (its base), indels belong to the read before them
+        is_read = (data != ord("$")) & (data != ord("\n"))
+        if keep is not None:
+            is_read &= keep
+        reads = np.flatnonzero(is_read)
+        del is_read
+        read_row = row[reads]
+        n_reads = np.bincount(read_row, minlength=n)
+        first = np.cumsum(n_reads) - n_reads
+        drawn = np.ones(len(reads), dtype=bool)
+        for i in np.flatnonzero(n_reads > Max_reads):
+            drawn[first[i]:first[i]+n_reads[i]] = False
+            drawn[first[i]+draw_reads(n_reads[i], Max_reads, Seed, positions[i])] = True
+        if indels:
+            indel_drawn = drawn[np.searchsorted(reads, start) - 1]
+            indel_row, length, is_insertion = indel_row[indel_drawn], length[indel_drawn], is_insertion[indel_drawn]
+        data, row = data[reads[drawn]], read_row[drawn]
+    elif keep is not None:
+        data = data[keep]
+        row = row[keep]
+    if indels:
+        counts[:, 4] = np.bincount(indel_row[is_insertion], weights=length[is_insertion], minlength=n)
+        counts[:, 5] = np.bincount(indel_row[~is_insertion], weights=length[~is_insertion], minlength=n)
+    for i, base in enumerate("ATGC"):
+        counts[:, i] = np.bincount(row[data == ord(base)], minlength=n)
+    counts[:, 5] += np.bincount(row[data == ord("*")], minlength=n)
+    return counts
+
 def find_all_indels(s):
     find_all = lambda c,s: [x for x in range(c.find(s), len(c)) if c[x] == s]
     list_pos = []
@@ -89,17 +272,23 @@ def find_all_indels(s):
         list_pos.append(i)    
     return sorted(list_pos)
 
+def get_indel_end(s, pos):
+    """
+    Returns the length of the indel starting at pos and the position right 
+    after its sequence, the length may have more than one digit (e.g. +12)
+    """
+    count = pos+1
+    while count < len(s) and s[count].isdigit():
+        count += 1
+    if count == pos+1: # in case it is not a number but a base pair e.g. A
+        return 1, pos+1
+    length = int(s[pos+1:count])
+    return length, count+length
+
 def count_indels(s, pos):    
     dict_indel = {"+":0,"-":0}    
-    if pos == []:
-        return dict_indel            
-    if len(pos) > 0:
-        for i in range(0,len(pos)): 
-            try: # in case it is not a number but a base pair e.g. A
-                dict_indel[s[pos[i]]] += int(s[pos[i]+1])                                                                        
-            except ValueError:                
-                dict_indel[s[pos[i]]] += 1
-                continue                
+    for i in pos:
+        dict_indel[s[i]] += get_indel_end(s, i)[0]
     return dict_indel
 
 def trimm_indels(s, pos):    
@@ -107,50 +296,25 @@ def trimm_indels(s, pos):
     if pos == []:
         return s
     u_sequence = ""  
-    start =  pos[0]
-    count = (start+1)    
-    try: # in case it is not a number but a base pair e.g. A
-        end = count+int(s[count])+1
-    except ValueError:                
-        end = start+1            
-    u_sequence = s[:start]    
-    if len(pos) > 1:
-        for i in range(1,len(pos)):                      
-            start = end                
-            u_sequence += s[start:pos[i]]
-            start = pos[i]
-            count = (start+1)            
-            try: # in case it is not a number but a base pair e.g. A
-                end = count+int(s[count])+1  
-            except ValueError:
-                end = start+1                
-            if pos[-1] == pos[i]:    
-                #print(s[end:])
-                u_sequence += s[end:]
-    else:        
-        u_sequence += s[end:]        
+    end = 0
+    for start in pos:
+        u_sequence += s[end:start]
+        end = get_indel_end(s, start)[1]
+    u_sequence += s[end:]
     return u_sequence
 
 def trimm_caret(s):       
-    find_all = lambda c,s: [x for x in range(c.find(s), len(c)) if c[x] == s]
-    list_pos = []
-    for i in find_all(s,"^"):
-        list_pos.append(i)    
-    if list_pos == []:
+    ## Removes the read starts (^) together with the mapping quality that follows them
+    start = s.find("^")
+    if start == -1:
         return s
-    i = 0    
-    start = 0
-    end = 0
     sequence = ""
-    while i<len(s):
-        if s[i] == "^":        
-            end = i
-            sequence += (s[start:end])                    
-            start = i+1
-        elif i >= list_pos[-1]+1:
-            sequence += (s[list_pos[-1]+1:])
-            break
-        i+=1        
+    end = 0
+    while start != -1:
+        sequence += s[end:start]
+        end = start+2
+        start = s.find("^", end)
+    sequence += s[end:]
     return sequence
 
 def execute_log(command):
@@ -173,36 +337,667 @@ def file_exists(file):
         # error: argument input: file does not exist
         raise argparse.ArgumentTypeError("{0} does not exist".format(file))
     return file
+
+def get_cpu_time():
+    """
+    CPU seconds used by this process and its finished subprocesses (samtools)
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def get_peak_rss():
+    """
+    Peak resident memory in MB of this process and of its largest subprocess
+    """
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 1), 
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0, 1))
+
+class StageMetrics(object):
+    """
+    Wall time, CPU time, peak RSS and rows processed of every stage of the 
+    sample that is being processed. Peak RSS is the peak of the process so far
+    """
+    columns = ["sample","stage","wall_s","cpu_s","peak_rss_mb","children_peak_rss_mb","rows"]
+
+    def __init__(self, sample=None):
+        self.reset(sample)
+
+    def reset(self, sample):
+        self.sample = sample
+        self.stages = []
+
+    def start(self, name):
+
+        return {"sample": self.sample, "stage": name, "rows": None, 
+                "wall_s": time.time(), "cpu_s": get_cpu_time()}
+
+    def stop(self, record, rows=None):
+
+        record["wall_s"] = round(time.time() - record["wall_s"], 4)
+        record["cpu_s"] = round(get_cpu_time() - record["cpu_s"], 4)
+        record["peak_rss_mb"], record["children_peak_rss_mb"] = get_peak_rss()
+        if rows is not None:
+            record["rows"] = rows
+        self.stages.append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measures the block of a with statement, the block can set the 
+        processed rows in the yielded record
+        """
+        record = self.start(name)
+        try:
+            yield record
+        finally:
+            self.stop(record)
+
+metrics = StageMetrics() # stages of the current sample of this process
+
+def write_metrics(stages, metrics_output):
+    """
+    Writes the stage metrics of a run as a table (.metrics) and as JSON lines 
+    (.metrics.json)
+    """
+    with open(metrics_output, "w") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(StageMetrics.columns)
+        for record in stages:
+            writer.writerow(["" if record.get(i) is None else record.get(i) for i in StageMetrics.columns])
+    with open(metrics_output+".json", "w") as f:
+        for record in stages:
+            f.write(json.dumps(dict((i, record.get(i)) for i in StageMetrics.columns))+"\n")
         
-def execute_mpileup(header, bam_file, pileupfile, Quality_thresh, folder):
+def execute_mpileup(header, bam_file, pileupfile, Quality_thresh, folder, bed_file=None, Reference=None):
             
-    cmd = "samtools mpileup -AQ{} -r {} {} > {}".format(Quality_thresh, header, bam_file, pileupfile)        
+    options = " ".join(get_reference_options(bam_file, Reference))
+    if bed_file:
+        cmd = "samtools mpileup {} -AQ{} -r {} -l {} {} > {}".format(options, Quality_thresh, header, bed_file, bam_file, pileupfile)
+    else:
+        cmd = "samtools mpileup {} -AQ{} -r {} {} > {}".format(options, Quality_thresh, header, bam_file, pileupfile)        
     subprocess.call(cmd, shell=True)                    
+
+def get_reference_options(bam_file, Reference=None):
+    """
+    samtools options to decode CRAM files with the Reference FASTA. The 
+    reference is only used to decode, -f would change the pileup output
+    """
+    bam_files = bam_file if isinstance(bam_file, list) else [bam_file]
+    if Reference and any(i.endswith(".cram") for i in bam_files):
+        return ["--input-fmt-option", "reference="+Reference]
+    return []
+
+def open_alignment_file(bam_file, Reference=None):
+    """
+    Opens a BAM or CRAM file with pysam, CRAM files are decoded with Reference
+    """
+    if bam_file.endswith(".cram"):
+        return pysam.AlignmentFile(bam_file, "rc", reference_filename=Reference)
+    return pysam.AlignmentFile(bam_file, "rb")
+
+def stream_mpileup(header, bam_file, Quality_thresh, bed_file=None, Reference=None):
+    """
+    Generator over the pileup lines of samtools mpileup read from a pipe, 
+    each line is returned already split into its columns. Raises 
+    CalledProcessError when samtools fails, the pileup would be incomplete
+    """
+    cmd = ["samtools", "mpileup"] + get_reference_options(bam_file, Reference)
+    cmd += ["-AQ{}".format(Quality_thresh), "-r", header]
+    if bed_file:
+        cmd += ["-l", bed_file]
+    if isinstance(bam_file, list): # one column group per BAM file, whatever their read groups
+        cmd += ["--ignore-RG"] + bam_file
+    else:
+        cmd.append(bam_file)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stdout:
+        yield line.rstrip("\n").split("\t")
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def read_pileup_stream(header, bam_file, Quality_thresh, positions, bed_file=None, Reference=None):
+    """
+    Consumes the mpileup stream keeping only the rows at marker positions. 
+    Returns the retained rows and the total number of pileup lines seen
+    """
+    rows = []
+    total = 0
+    for fields in stream_mpileup(header, bam_file, Quality_thresh, bed_file, Reference):
+        total += 1
+        if int(fields[1]) in positions:
+            rows.append(fields[:6])
+    Pileupfile = pd.DataFrame(rows, columns=['chr', 'pos', 'refbase', 'reads', 'align', 'quality'])
+    Pileupfile = Pileupfile.astype({'pos':int, 'reads':int})
+    return Pileupfile, total
+
+def read_plate_pileup(header, bam_files, Quality_thresh, positions, bed_file=None, Reference=None, Max_depth=0, Seed=0):
+    """
+    Consumes a single mpileup stream of all BAM files of a plate keeping the 
+    rows at marker positions. The pileup strings are counted in chunks of 
+    lines as they are read, only the counts are kept. Returns the positions, 
+    the reads (samples x positions) and the A,T,G,C,+,- counts (samples x 
+    positions x 6)
+    """
+    rows = []
+    depths = []
+    counts = []
+    aligns = []
+    size = 0
+    for fields in stream_mpileup(header, bam_files, Quality_thresh, bed_file, Reference):
+        if int(fields[1]) in positions:
+            rows.append(int(fields[1]))
+            depths.append(np.array(fields[3::3], dtype=np.int64))
+            aligns.append(fields[4::3])
+            size += sum(len(i) for i in aligns[-1])
+            if size >= pileup_chunk_chars:
+                counts.append(count_plate_columns(aligns, depths[-len(aligns):], rows[-len(aligns):], Max_depth, Seed))
+                aligns, size = [], 0
+    if aligns:
+        counts.append(count_plate_columns(aligns, depths[-len(aligns):], rows[-len(aligns):], Max_depth, Seed))
+    reads = np.array(depths, dtype=np.int64).reshape(len(rows), len(bam_files))
+    counts = np.concatenate(counts) if counts else np.zeros((0, len(bam_files), 6), dtype=np.int64)
+    return np.array(rows, dtype=np.int64), np.ascontiguousarray(reads.T), np.ascontiguousarray(counts.transpose(1, 0, 2))
+
+def count_plate_columns(aligns, depths, positions, Max_depth=0, Seed=0):
+    """
+    A,T,G,C,+,- counts (lines x samples x 6) of the sample columns of a chunk 
+    of plate pileup lines, samples without reads at a line are not counted
+    """
+    reads = np.array(depths, dtype=np.int64).reshape(len(aligns), -1)
+    counts = np.zeros(reads.shape+(6,), dtype=np.int64)
+    covered = reads > 0
+    counts[covered] = count_pileup_bases([align for line, line_reads in zip(aligns, reads) 
+                                          for align, n in zip(line, line_reads) if n > 0], Max_depth, 
+                                         np.repeat(positions, covered.sum(axis=1)), Seed)
+    return counts
+
+def read_plate_coverage(header, bam_files, positions, bed_file, Reference=None):
+    """
+    Samples (rows) with reads at each of the positions (columns) before the 
+    base quality filter, from a mpileup with -Q0 of the positions of bed_file. 
+    A single sample mpileup has a line (with zero reads) for these positions
+    """
+    columns = dict((pos, i) for i, pos in enumerate(positions))
+    covered = np.zeros((len(bam_files), len(positions)), dtype=bool)
+    for fields in stream_mpileup(header, bam_files, 0, bed_file, Reference):
+        if int(fields[1]) in columns:
+            covered[:, columns[int(fields[1])]] = np.array(fields[3::3], dtype=np.int64) > 0
+    return covered
+
+def read_pileup(path_Pileupfile):
+
+    Pileupfile = pd.read_csv(path_Pileupfile, header=None, sep="\t", dtype = {0:str,1:int,2:str,3:int,4:str,5:str})
+    Pileupfile.columns = ['chr', 'pos', 'refbase', 'reads', 'align', 'quality']
+    return Pileupfile
+
+class MarkerDatabase(object):
+    """
+    Markers of the positions file sorted by position (for duplicated positions 
+    the first marker is kept). Positions are looked up with a binary search on 
+    the sorted array so lookups and intersections are O(log n) per position
+    """
+    columns = ["chr", "marker_name", "haplogroup", "pos", "mutation", "anc", "der"]
+
+    def __init__(self, content):
+        self.md5 = hashlib.md5(content).hexdigest()
+        rows = [line.split("\t") for line in content.decode().splitlines() if line.strip() != ""]
+        table = dict((column, np.array([row[i] for row in rows], dtype=object)) 
+                     for i, column in enumerate(self.columns))
+        table["pos"] = table["pos"].astype(np.int64)
+        ## first marker of every position, sorted by position
+        self.positions, first = np.unique(table["pos"], return_index=True)
+        self.table = dict((column, table[column][first]) for column in self.columns)
+        self._markers = None
+
+    @property
+    def markers(self):
+        """
+        Marker table as a DataFrame, built on first use
+        """
+        if self._markers is None:
+            self._markers = pd.DataFrame(collections.OrderedDict((i, self.table[i]) for i in self.columns))
+        return self._markers
+
+    def lookup(self, positions):
+        """
+        Row of every position in the marker table, -1 if it is not a marker position
+        """
+        positions = np.asarray(positions, dtype=self.positions.dtype)
+        rows = np.searchsorted(self.positions, positions)
+        rows[rows == len(self.positions)] = 0
+        found = len(self.positions) > 0 and self.positions[rows] == positions
+        return np.where(found, rows, -1)
+
+    def contains(self, positions):
+
+        return self.lookup(positions) >= 0
+
+    def intersect(self, positions):
+        """
+        Sorted marker positions found in positions
+        """
+        rows = self.lookup(positions)
+        return self.positions[np.unique(rows[rows >= 0])]
+
+    def get_markers(self, positions):
+        """
+        Marker table restricted to the given positions, sorted by position
+        """
+        return self.markers.iloc[self.get_rows(positions)]
+
+    def get_rows(self, positions):
+        """
+        Rows of the marker table found in positions, sorted by position
+        """
+        rows = self.lookup(positions)
+        return np.unique(rows[rows >= 0])
+
+marker_databases = {}
+
+def load_marker_database(path_Markerfile):
+    """
+    Loads the positions file once per process, the parsed database is reused 
+    as long as the md5 of the positions file does not change
+    """
+    path_Markerfile = os.path.abspath(path_Markerfile)
+    with open(path_Markerfile, "rb") as f:
+        content = f.read()
+    md5 = hashlib.md5(content).hexdigest()
+    if path_Markerfile not in marker_databases or marker_databases[path_Markerfile].md5 != md5:
+        marker_databases[path_Markerfile] = MarkerDatabase(content)
+    return marker_databases[path_Markerfile]
+
+def get_marker_positions(path_Markerfile):
     
-def chromosome_table(bam_file,bam_folder,file_name):
+    return load_marker_database(path_Markerfile).positions
+
+def write_marker_bed(path_Markerfile, header, bed_output):
+    """
+    Writes one BED interval per marker position so mpileup only visits the 
+    sites of the marker panel. Chromosome name is taken from the BAM (Y or chrY)
+    """
+    write_bed(get_marker_positions(path_Markerfile), header, bed_output)
+
+def write_bed(positions, header, bed_output):
+
+    with open(bed_output, "w") as bed:
+        for pos in positions:
+            bed.write("{}\t{}\t{}\n".format(header, pos-1, pos))
     
-    output = bam_folder+'/'+file_name+'.chr'
-    tmp_output = "tmp_bam.txt"
-
-    f = open(tmp_output, "w")
-    subprocess.call(["samtools", "idxstats",bam_file], stdout=f)
-    df_chromosome = pd.read_table(tmp_output, header=None)
-    total_reads = sum(df_chromosome[2])
-    df_chromosome["perc"] = (df_chromosome[2]/total_reads)*100
-    df_chromosome = df_chromosome.round(decimals=2)
-    df_chromosome['perc'] = df_chromosome['perc'].astype(str) + '%'
-    df_chromosome = df_chromosome.drop(columns=[1,3])
-    df_chromosome.columns = ['chr','reads','perc']    
-    df_chromosome.to_csv(output, index=None, sep="\t")
+def pysam_counts(bam_file, header, positions, Quality_thresh, Reference=None, Max_depth=0, Seed=0):
+    """
+    In-process alternative to samtools mpileup. Opens the BAM once and counts 
+    the bases of the marker positions only, with the same filters as 
+    samtools mpileup -A -Q (orphans kept, overlapping mates, max depth 8000). 
+    Returns a table with the read depth and A,T,G,C,+,- counts per position
+    """
+    return pd.DataFrame(pysam_count_columns(bam_file, header, positions, Quality_thresh, Reference, Max_depth, Seed))
+
+def pysam_count_columns(bam_file, header, positions, Quality_thresh, Reference=None, Max_depth=0, Seed=0):
+    """
+    pysam_counts as a dictionary of NumPy columns. Only the reads (CRAM 
+    slices) overlapping the positions are decoded, with Max_depth only the 
+    bases of Max_depth reads of a position drawn as in count_pileup_bases 
+    are counted
+    """
+    bases = ["A","T","G","C","+","-"]
+    rows = []
+    with open_alignment_file(bam_file, Reference) as bam:
+        for pos in positions:
+            for column in bam.pileup(header, pos-1, pos, truncate=True, stepper="samtools", 
+                                     ignore_orphans=False, ignore_overlaps=True, 
+                                     min_base_quality=Quality_thresh, max_depth=8000):
+                fastadict = {"A":0,"T":0,"G":0,"C":0,"+":0,"-":0}
+                sequences = column.get_query_sequences(mark_matches=False, mark_ends=False, add_indels=True)
+                drawn = sequences
+                if Max_depth and len(sequences) > Max_depth:
+                    drawn = [sequences[i] for i in draw_reads(len(sequences), Max_depth, Seed, pos)]
+                for seq in drawn:
+                    seq = seq.upper()
+                    if seq == "":
+                        continue
+                    if seq[0] == "*":
+                        fastadict["-"] += 1
+                    elif seq[0] in fastadict:
+                        fastadict[seq[0]] += 1
+                    if len(seq) > 1 and seq[1] in "+-":
+                        fastadict[seq[1]] += int("".join(c for c in seq[2:] if c.isdigit()))
+                rows.append([pos, len(sequences)] + [fastadict[b] for b in bases])
+    rows = np.array(rows, dtype=np.int64).reshape(len(rows), 2+len(bases))
+    columns = collections.OrderedDict([("chr", np.array([header]*len(rows), dtype=object)), ("pos", rows[:,0]), 
+                                       ("refbase", np.array(["N"]*len(rows), dtype=object)), ("reads", rows[:,1])])
+    for i, base in enumerate(bases):
+        columns[base] = rows[:,2+i]
+    return columns
+
+def read_bam_references(bam_file):
+    """
+    Name and length of the reference sequences of the BAM header, only the 
+    header is decompressed
+    """
+    with gzip.open(bam_file, "rb") as bam:
+        if bam.read(4) != b"BAM\1":
+            raise ValueError("not a BAM file: "+bam_file)
+        l_text = struct.unpack("<i", bam.read(4))[0]
+        bam.read(l_text)
+        n_ref = struct.unpack("<i", bam.read(4))[0]
+        references = []
+        for i in range(n_ref):
+            l_name = struct.unpack("<i", bam.read(4))[0]
+            name = bam.read(l_name).rstrip(b"\0").decode()
+            references.append((name, struct.unpack("<i", bam.read(4))[0]))
+    return references
+
+def read_itf8(f):
+    """
+    Reads a CRAM ITF8 integer (1 to 5 bytes, signed 32 bit)
+    """
+    first = f.read(1)
+    if first == b"":
+        raise EOFError("truncated CRAM file")
+    first = first[0]
+    if first < 0x80:
+        return first
+    n = 1 if first < 0xC0 else 2 if first < 0xE0 else 3 if first < 0xF0 else 4
+    rest = f.read(n)
+    if len(rest) != n:
+        raise EOFError("truncated CRAM file")
+    if n == 4:
+        value = ((first & 0x0F) << 28) | (rest[0] << 20) | (rest[1] << 12) | (rest[2] << 4) | (rest[3] & 0x0F)
+    else:
+        value = first & (0xFF >> (n+1))
+        for byte in rest:
+            value = (value << 8) | byte
+    return value - (1 << 32) if value >= (1 << 31) else value
+
+def skip_ltf8(f):
+    """
+    Skips a CRAM LTF8 integer (1 to 9 bytes)
+    """
+    first = f.read(1)[0]
+    n = 0
+    while n < 8 and first & (0x80 >> n):
+        n += 1
+    f.read(n)
+
+def read_cram_references(f):
+    """
+    Name and length of the reference sequences of the SAM header block of a
+    CRAM file, raw or gzip compressed
+    """
+    method = f.read(1)[0]
+    f.read(1) # content type
+    read_itf8(f) # content id
+    compressed_size = read_itf8(f)
+    read_itf8(f) # raw size
+    data = f.read(compressed_size)
+    if method == 1:
+        data = gzip.decompress(data)
+    elif method != 0:
+        raise ValueError("unsupported compression of the CRAM header")
+    l_text = struct.unpack_from("<i", data)[0]
+    references = []
+    for line in data[4:4+l_text].decode().splitlines():
+        if line.startswith("@SQ"):
+            fields = dict(field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+            references.append((fields["SN"], int(fields["LN"])))
+    return references
+
+def read_cram_statistics(cram_file):
+    """
+    Reads of every reference sequence of a coordinate sorted CRAM file, summed
+    from the record counts of its container headers. The reads are not
+    decoded (the data of each container is skipped) and placed unmapped reads
+    are counted as mapped to their reference. Also returns the offsets of 
+    the containers with several reference sequences, which are not counted
+    """
+    with open(cram_file, "rb") as f:
+        definition = f.read(26)
+        if definition[:4] != b"CRAM" or definition[4] not in (2, 3):
+            raise ValueError("unsupported CRAM file: "+cram_file)
+        major = definition[4]
+        references = None
+        stats = None
+        no_coordinate = 0
+        multi_ref = set()
+        while True:
+            offset = f.tell()
+            length = f.read(4)
+            if len(length) < 4:
+                break
+            length = struct.unpack("<i", length)[0]
+            ref_id = read_itf8(f)
+            read_itf8(f) # alignment start
+            read_itf8(f) # alignment span
+            n_records = read_itf8(f)
+            skip_ltf8(f) # record counter
+            skip_ltf8(f) # bases
+            read_itf8(f) # blocks
+            for i in range(read_itf8(f)): # landmarks
+                read_itf8(f)
+            if major >= 3:
+                f.read(4) # crc32
+            data_start = f.tell()
+            if references is None:
+                references = read_cram_references(f)
+                stats = [0]*len(references)
+            elif ref_id == -1:
+                no_coordinate += n_records
+            elif 0 <= ref_id < len(references):
+                stats[ref_id] += n_records
+            elif ref_id == -2:
+                multi_ref.add(offset)
+            else:
+                raise ValueError("unknown reference sequence in CRAM container: "+cram_file)
+            f.seek(data_start + length)
+    if references is None:
+        raise ValueError("CRAM file without header: "+cram_file)
+    return references, [(mapped, 0) for mapped in stats], no_coordinate, multi_ref
+
+def get_multi_ref_ids(index_file, multi_ref):
+    """
+    Reference sequences (-1 for reads without coordinates) with slices in the 
+    containers at the offsets of multi_ref, from the CRAI index
+    """
+    ref_ids = set()
+    with gzip.open(index_file, "rt") as f:
+        for line in f:
+            fields = line.split("\t")
+            if len(fields) >= 6 and int(fields[3]) in multi_ref:
+                ref_ids.add(int(fields[0]))
+    return ref_ids
+
+def count_reference_reads(bam_file, contigs, Engine="samtools", Reference=None):
+    """
+    Reads of the reference sequences in contigs ("*" for reads without 
+    coordinates) counted by decoding them through the index
+    """
+    if Engine == "pysam":
+        with open_alignment_file(bam_file, Reference) as bam:
+            return dict((contig, bam.count(contig)) for contig in contigs)
+    return dict((contig, int(subprocess.check_output(["samtools", "view"] + get_reference_options(bam_file, Reference) + 
+                                                     ["-c", bam_file, contig], universal_newlines=True)))
+                for contig in contigs)
+
+def cram_statistics(bam_file, Engine="samtools", Reference=None):
+    """
+    Reference sequences, reads of every reference sequence and reads without 
+    coordinates of a CRAM file. Only the reference sequences that share a 
+    container with others are decoded and counted
+    """
+    references, stats, no_coordinate, multi_ref = read_cram_statistics(bam_file)
+    if multi_ref:
+        index_file = find_bam_index(bam_file)
+        if index_file is None:
+            raise ValueError("CRAM file without index: "+bam_file)
+        ref_ids = sorted(get_multi_ref_ids(index_file, multi_ref))
+        contigs = [references[i][0] if i >= 0 else "*" for i in ref_ids]
+        counts = count_reference_reads(bam_file, contigs, Engine, Reference)
+        for i, contig in zip(ref_ids, contigs):
+            if i >= 0:
+                stats[i] = (counts[contig], 0)
+            else:
+                no_coordinate = counts[contig]
+    return references, stats, no_coordinate
+
+def read_index(index_file):
+    """
+    Parses a BAI or CSI index. Returns the mapped and unmapped reads of every 
+    reference sequence kept in its pseudo-bin, its linear index (BAI only, 
+    None for CSI) and the number of reads without coordinates
+    """
+    with open(index_file, "rb") as f:
+        content = f.read()
+    if content[:2] == b"\x1f\x8b": # CSI indexes are BGZF compressed
+        content = gzip.decompress(content)
+    magic = content[:4]
+    if magic == b"BAI\1":
+        offset = 4
+        pseudo_bin = 37450
+        loffset = 0
+    elif magic == b"CSI\1":
+        min_shift, depth, l_aux = struct.unpack_from("<iii", content, 4)
+        offset = 16 + l_aux
+        pseudo_bin = ((1 << ((depth+1)*3)) - 1)//7 + 1
+        loffset = 8
+    else:
+        raise ValueError("unknown index format: "+index_file)
+    n_ref = struct.unpack_from("<i", content, offset)[0]
+    offset += 4
+    stats = []
+    linear = []
+    for i in range(n_ref):
+        n_bin = struct.unpack_from("<i", content, offset)[0]
+        offset += 4
+        mapped, unmapped = 0, 0
+        for j in range(n_bin):
+            bin_id = struct.unpack_from("<I", content, offset)[0]
+            n_chunk = struct.unpack_from("<i", content, offset+4+loffset)[0]
+            offset += 8 + loffset
+            if bin_id == pseudo_bin:
+                mapped, unmapped = struct.unpack_from("<QQ", content, offset+16)
+            offset += 16*n_chunk
+        if magic == b"BAI\1": # linear index
+            n_intv = struct.unpack_from("<i", content, offset)[0]
+            linear.append(np.frombuffer(content, dtype="<u8", count=n_intv, offset=offset+4))
+            offset += 4 + 8*n_intv
+        else:
+            linear.append(None)
+        stats.append((mapped, unmapped))
+    no_coordinate = 0
+    if len(content) >= offset+8:
+        no_coordinate = struct.unpack_from("<Q", content, offset)[0]
+    return stats, linear, no_coordinate
+
+def read_index_statistics(index_file):
+    """
+    Mapped and unmapped reads of every reference sequence (what samtools 
+    idxstats reports) and the number of reads without coordinates
+    """
+    stats, linear, no_coordinate = read_index(index_file)
+    return stats, no_coordinate
+
+def get_window_sizes(bam_file, header):
+    """
+    Compressed bytes of the reads starting in every 16 kb window of a 
+    reference sequence, from the linear index of a BAI file. Used as an 
+    estimate of the depth, None when it is not available (CSI)
+    """
+    try:
+        references = [name for name, length in read_bam_references(bam_file)]
+        stats, linear, no_coordinate = read_index(find_bam_index(bam_file))
+        offsets = linear[references.index(header)]
+    except (ValueError, TypeError, IOError, OSError, struct.error, EOFError, IndexError):
+        return None
+    if offsets is None or len(offsets) == 0:
+        return None
+    offsets = np.maximum.accumulate((offsets >> 16).astype(np.int64)) # empty windows keep the previous offset
+    return np.append(np.diff(offsets), 0)
+
+def index_statistics(bam_file, Engine="samtools", Reference=None):
+    """
+    Rows of samtools idxstats (contig, length, mapped, unmapped) read from the 
+    BAM index, or from the container headers of a CRAM file (.crai indexes 
+    have no read counts), in-process. Falls back to pysam or samtools idxstats 
+    when they can not be read
+    """
+    is_cram = bam_file.endswith(".cram")
+    try:
+        if is_cram:
+            references, stats, no_coordinate = cram_statistics(bam_file, Engine, Reference)
+        else:
+            index_file = find_bam_index(bam_file)
+            references = read_bam_references(bam_file)
+            stats, no_coordinate = read_index_statistics(index_file)
+            if len(stats) != len(references):
+                raise ValueError("index does not match the BAM header: "+index_file)
+        rows = [[name, length, mapped, unmapped] for (name, length), (mapped, unmapped) in zip(references, stats)]
+        rows.append(["*", 0, 0, no_coordinate])
+        return rows
+    except (ValueError, TypeError, IOError, OSError, struct.error, EOFError, IndexError, KeyError):
+        pass
+    if Engine == "pysam" and not is_cram:
+        with pysam.AlignmentFile(bam_file, "rb") as bam:
+            rows = [[i.contig, bam.get_reference_length(i.contig), i.mapped, i.unmapped] 
+                    for i in bam.get_index_statistics()]
+            rows.append(["*", 0, 0, bam.unmapped])
+        return rows
+    if Engine == "pysam":
+        idxstats = pysam.idxstats(bam_file)
+    else:
+        idxstats = subprocess.check_output(["samtools", "idxstats", bam_file], universal_newlines=True)
+    return [[line.split("\t")[0]]+[int(i) for i in line.split("\t")[1:4]] for line in idxstats.splitlines() if line.strip() != ""]
+
+def chromosome_table(bam_file,bam_folder,file_name,Engine="samtools",Reference=None):
     
-    cmd = "rm "+tmp_output
-    subprocess.call(cmd, shell=True)
+    output = bam_folder+'/'+file_name+'.chr'
+
+    rows = [[contig, mapped] for contig, length, mapped, unmapped in index_statistics(bam_file, Engine, Reference)]
+    total_reads = sum(reads for contig, reads in rows)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        perc = np.round(np.array([reads for contig, reads in rows], dtype=np.int64)/total_reads*100, 2)
+    with open(output, "w") as f:
+        f.write("chr\treads\tperc\n")
+        for (contig, reads), contig_perc in zip(rows, perc):
+            f.write("{}\t{}\t{}%\n".format(contig, reads, float(contig_perc)))
+    chromosomes = [contig for contig, reads in rows]
 
-    if 'Y' in df_chromosome["chr"].values:
+    if 'Y' in chromosomes:
         return "Y", total_reads    
-    elif 'chrY' in df_chromosome["chr"].values:
+    elif 'chrY' in chromosomes:
         return "chrY", total_reads    
-    
+    return None, total_reads
+
+class InsufficientYCoverage(Exception):
+    """
+    Raised when a sample has too few reads on chromosome Y to be called
+    """
+    status = "insufficient Y coverage"
+
+    def __init__(self, y_reads, y_perc):
+        Exception.__init__(self, "{} reads ({}%) mapped to chromosome Y".format(y_reads, y_perc))
+        self.y_reads = y_reads
+        self.y_perc = y_perc
+
+def triage_y_coverage(chr_output, Min_Y_reads=0, Min_Y_perc=0.0):
+    """
+    Raises InsufficientYCoverage when the reads mapped to chromosome Y in the 
+    .chr table are below Min_Y_reads or Min_Y_perc, or there is no Y contig
+    """
+    y_reads, y_perc = None, 0.0
+    with open(chr_output) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] in ("Y", "chrY"):
+                y_reads, y_perc = int(fields[1]), float(fields[2].rstrip("%"))
+                break
+    if y_reads is None:
+        raise InsufficientYCoverage(0, 0.0)
+    if y_reads < Min_Y_reads or y_perc < Min_Y_perc:
+        raise InsufficientYCoverage(y_reads, y_perc)
+    return y_reads, y_perc
+
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for x in range(size))
 
@@ -225,10 +1020,18 @@ def get_folder_name(path_file):
     folder_name = os.path.splitext(folder)[0]        
     return folder_name
 
-def create_tmp_dirs(folder):
+def create_tmp_dirs(folder, Force=False, Keep=False):
 
     flag = True
-    if os.path.isdir(folder):    
+    if os.path.isdir(folder) and Keep:
+        return True
+    elif os.path.isdir(folder) and Force:
+        cmd = 'rm -r '+folder
+        subprocess.call(cmd, shell=True)
+        cmd = 'mkdir '+folder
+        subprocess.call(cmd, shell=True)                
+        return True
+    elif os.path.isdir(folder):    
         while(flag):
             print("WARNING! File "+folder+" already exists, \nWould you like to remove it?")
             choice = input("y/n: ")            
@@ -249,24 +1052,61 @@ def create_tmp_dirs(folder):
         subprocess.call(cmd, shell=True)        
         return True
     
-def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority, 
-                        path_Pileupfile, log_output, fmf_output, Outputfile):    
+def get_file_checksum(path, block_size=1048576):
+    """
+    md5 of the first and last block of a file, enough to notice a replaced 
+    BAM file without reading tens of GB
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        md5.update(f.read(block_size))
+        f.seek(max(os.path.getsize(path)-block_size, 0))
+        md5.update(f.read(block_size))
+    return md5.hexdigest()
 
-    print("Extracting haplogroups...")
-    Markerfile = pd.read_csv(path_Markerfile, header=None, sep="\t")
-    Markerfile.columns = ["chr", "marker_name", "haplogroup", "pos", "mutation", "anc", "der"]
-    Markerfile = Markerfile.drop_duplicates(subset='pos', keep='first', inplace=False)    
+def get_manifest(bam_file, Markerfile, params):
+    """
+    Identity of a sample run: input BAM, marker file and thresholds used
+    """
+    stat = os.stat(bam_file)
+    marker_md5 = load_marker_database(Markerfile).md5
+    manifest = {"bam_file": os.path.abspath(bam_file), "bam_size": stat.st_size, 
+                "bam_mtime": stat.st_mtime, "bam_checksum": get_file_checksum(bam_file), 
+                "marker_md5": marker_md5}
+    manifest.update(params)
+    return manifest
 
-    Pileupfile = pd.read_csv(path_Pileupfile, header=None, sep="\t", dtype = {0:str,1:int,2:str,3:int,4:str,5:str})
-    Pileupfile.columns = ['chr', 'pos', 'refbase', 'reads', 'align', 'quality']
-    
-    log_output_list = []
-    log_output_list.append("Total of reads: "+str(len(Pileupfile))) #total of reads
+def write_manifest(folder, folder_name, manifest):
 
-    intersect_pos = np.intersect1d(Pileupfile['pos'], Markerfile['pos'])
-    Markerfile = Markerfile.loc[Markerfile['pos'].isin(intersect_pos)]
-    Markerfile = Markerfile.sort_values(by=['pos'])
-    Pileupfile = Pileupfile.loc[Pileupfile['pos'].isin(intersect_pos)]
+    with open(folder+"/"+folder_name+".manifest", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def sample_is_complete(folder, folder_name, manifest):
+    """
+    True when the outputs of a previous run exist and were computed from 
+    the same BAM file, marker file and thresholds
+    """
+    if manifest.get("Binary"):
+        outputs = [folder+"/"+folder_name+ext for ext in [".out.npz", ".fmf.npz", ".log", ".manifest"]]
+    else:
+        outputs = [folder+"/"+folder_name+ext for ext in [".out", ".fmf", ".log", ".manifest"]]
+    if not all(os.path.exists(i) for i in outputs):
+        return False
+    try:
+        with open(folder+"/"+folder_name+".manifest") as f:
+            return json.load(f) == manifest
+    except ValueError:
+        return False
+
+def call_markers(path_Markerfile, Pileupfile, Max_depth=0, Seed=0):
+    """
+    Joins the pileup (or base counts) with the marker file and calls the base, 
+    its percentage and the A/D state of every marker. Returns the called markers, 
+    the markers with zero reads and the number of sites capped at Max_depth reads
+    """
+    markers = load_marker_database(path_Markerfile)
+    Markerfile = markers.get_markers(Pileupfile['pos'].values)
+    Pileupfile = Pileupfile.loc[markers.contains(Pileupfile['pos'].values)]
 
     Pileupfile = Pileupfile.drop(['chr'], axis=1)
     df = pd.merge(Markerfile, Pileupfile, on='pos')
@@ -276,11 +1116,11 @@ def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority,
     Pileupfile=pd.DataFrame()
     Markerfile=pd.DataFrame()
 
-    log_output_list.append("Valid markers: "+str(len(df))) #valid markers provided
+    pileup_columns = ['refbase','align','quality',"A","T","G","C","+","-"]
 
     index_belowzero = df[df["reads"] == 0].index
     df_belowzero = df[df.index.isin(index_belowzero)]
-    df_belowzero = df_belowzero.drop(['refbase','align','quality'], axis=1)
+    df_belowzero = df_belowzero.drop(columns=pileup_columns, errors='ignore')
     df_belowzero["called_perc"] = "NA"
     df_belowzero["called_base"] = "NA"
     df_belowzero["state"] = "NA"
@@ -288,9 +1128,13 @@ def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority,
 
     df = df[~df.index.isin(index_belowzero)]
 
-    df_freq_table = get_frequency_table(df)
+    if 'align' in df.columns:
+        df_freq_table = get_frequency_table(df, Max_depth, Seed)
+    else: # counts already computed by the pileup engine
+        df_freq_table = df[["A","T","G","C","+","-"]]
     df_freq_table = df_freq_table.drop(['+','-'], axis=1)
-    df = df.drop(['refbase','align','quality'], axis=1)
+    df = df.drop(columns=pileup_columns, errors='ignore')
+    n_capped = int(np.sum(df["reads"].values > Max_depth)) if Max_depth else 0
 
     list_col_indices = np.argmax(df_freq_table.values, axis=1)
     called_base = df_freq_table.columns[list_col_indices]
@@ -312,6 +1156,31 @@ def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority,
     df["state"] = bool_list_anc
     df["bool_state"] = bool_list_state
 
+    del [[df_freq_table]]
+    return df, df_belowzero, n_capped
+
+def get_out_table(df_out):
+
+    df_out = df_out.sort_values(by=['haplogroup'], ascending=True)
+    return df_out[["chr","pos","marker_name","haplogroup","mutation","anc","der","reads","called_perc","called_base","state"]]
+
+def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority, 
+                        Pileupfile, log_output, fmf_output, Outputfile, total_pileup=None, Binary=False, 
+                        Max_depth=0, Seed=0):    
+
+    print("Extracting haplogroups...")
+    if total_pileup is None:
+        total_pileup = len(Pileupfile)
+    
+    log_output_list = []
+    log_output_list.append("Total of reads: "+str(total_pileup)) #total of reads
+
+    stage = metrics.start("filtering")
+    df, df_belowzero, n_capped = call_markers(path_Markerfile, Pileupfile, Max_depth, Seed)
+    bool_list_state = df["bool_state"].values.astype(bool)
+
+    log_output_list.append("Valid markers: "+str(len(df)+len(df_belowzero))) #valid markers provided
+
     df_discordantgenotype = df[~bool_list_state]
     df_discordantgenotype = df_discordantgenotype.drop(["bool_state"], axis=1)
     df_discordantgenotype["state"] = "NA"
@@ -335,7 +1204,6 @@ def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority,
 
     df_out = df[~df.index.isin(index_to_remove)]
     df_out = df_out.drop(["bool_state"], axis=1)
-    df_out = df_out.sort_values(by=['haplogroup'], ascending=True)
 
     log_output_list.append("Markers with zero reads: "+str(len(df_belowzero))) 
     log_output_list.append("Markers below the read threshold {"+str(Reads_thresh)+"}: "+str(len(df_readsthreshold))) 
@@ -343,74 +1211,727 @@ def extract_haplogroups(path_Markerfile, Reads_thresh, Base_majority,
     log_output_list.append("Markers with discordant genotype: "+str(len(df_discordantgenotype))) 
     log_output_list.append("Markers without haplogroup information: "+str(len(df_fmf))) 
     log_output_list.append("Markers with haplogroup information: "+str(len(df_out))) 
+    if Max_depth:
+        log_output_list.append("Sites with depth capped at {"+str(Max_depth)+"} reads: "+str(n_capped)) 
+    metrics.stop(stage, len(Pileupfile))
 
+    stage = metrics.start("write")
     with open(log_output, "a") as log:
         for marker in log_output_list:
             log.write(marker)
             log.write("\n")
 
-    del [[df_basemajority,df_belowzero, df_discordantgenotype, df_readsthreshold, df_freq_table, df]]
+    del [[df_basemajority,df_belowzero, df_discordantgenotype, df_readsthreshold, df]]
     gc.collect()
     df_basemajority=pd.DataFrame()
     df_belowzero=pd.DataFrame()
     df_discordantgenotype=pd.DataFrame()
     df_readsthreshold=pd.DataFrame()
-    df_freq_table=pd.DataFrame()
     df = pd.DataFrame()
         
-    df_out = df_out[["chr","pos","marker_name","haplogroup","mutation","anc","der","reads","called_perc","called_base","state"]]
-    df_fmf.to_csv(fmf_output, sep="\t", index=False)
-    df_out.to_csv(Outputfile, sep="\t", index=False)
+    df_out = get_out_table(df_out)
+    if Binary:
+        predict_haplogroup.write_call_table(df_fmf, fmf_output+".npz")
+        predict_haplogroup.write_call_table(df_out, Outputfile+".npz")
+    else:
+        df_fmf.to_csv(fmf_output, sep="\t", index=False)
+        df_out.to_csv(Outputfile, sep="\t", index=False)
+    metrics.stop(stage, len(df_out)+len(df_fmf))
+    return df_out
 
-def samtools(folder, folder_name, bam_file, Quality_thresh, Markerfile):
+def get_count_columns(df_counts):
+    """
+    Base counts as a dictionary of NumPy columns (a DataFrame is converted)
+    """
+    if isinstance(df_counts, dict):
+        return df_counts
+    return collections.OrderedDict((i, df_counts[i].values) for i in df_counts.columns)
+
+def write_table(columns, table, output):
+    """
+    Writes the columns of a table as tab separated text, the same as 
+    DataFrame.to_csv(sep="\t", index=False)
+    """
+    with open(output, "w") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(zip(*[table[i] for i in columns]))
+
+def call_states(freq_table, anc, der):
+    """
+    Called base, its percentage and the A/D state from the A,T,G,C counts 
+    (last axis of freq_table) of any number of markers and samples at once. 
+    bool_state is False for discordant genotypes
+    """
+    bases = np.array(["A","T","G","C"], dtype=object)
+    called_base = bases[np.argmax(freq_table, axis=-1)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        called_perc = np.round((np.max(freq_table, axis=-1, initial=0)/np.sum(freq_table, axis=-1))*100,1)
+        called_perc = called_perc.astype(int)
+    state = np.where(called_base == anc, 'A', 'D').astype(object)
+    bool_state = state == np.where(called_base == der, 'D', 'A')
+    return called_base, called_perc, state, bool_state
+
+def write_sample_calls(table, called_base, called_perc, state, bool_state, Reads_thresh, Base_majority, 
+                       log_output, fmf_output, Outputfile, total_pileup, Binary=False, Max_depth=0, n_capped=0):
+    """
+    Filters the called markers of one sample (marker columns and reads in 
+    table, sorted by position) like extract_haplogroups and writes the same 
+    .log, .fmf and .out files. Returns the .out columns
+    """
+    log_output_list = []
+    log_output_list.append("Total of reads: "+str(total_pileup)) #total of reads
+
+    stage = metrics.start("filtering")
+    reads = table["reads"]
+    belowzero = reads == 0
+    called = np.flatnonzero(~belowzero)
+    called_base, called_perc, state, bool_state = called_base[called], called_perc[called], state[called], bool_state[called]
+
+    below_reads = reads[called] < Reads_thresh
+    below_majority = called_perc < Base_majority
+    discordant = ~bool_state
+    passed = ~(below_reads | below_majority | discordant)
+    n_belowzero = np.sum(belowzero)
+
+    ## .fmf: zero reads, below read threshold, below base majority and discordant markers
+    fmf_rows = np.concatenate([np.flatnonzero(belowzero), called[below_reads], called[below_majority], called[discordant]])
+    df_fmf = dict((i, table[i][fmf_rows]) for i in MarkerDatabase.columns+["reads"])
+    na = np.array(["NA"]*n_belowzero, dtype=object)
+    df_fmf["called_perc"] = np.concatenate([na.astype(object) if n_belowzero else na.astype(int)]+
+                                           [called_perc[i] for i in [below_reads, below_majority, discordant]])
+    df_fmf["called_base"] = np.concatenate([na]+[called_base[i] for i in [below_reads, below_majority, discordant]])
+    df_fmf["state"] = np.concatenate([na, state[below_reads], state[below_majority], 
+                                      np.array(["NA"]*np.sum(discordant), dtype=object)])
+    df_fmf["Description"] = np.array(["Position with zero reads"]*n_belowzero+["Below read threshold"]*np.sum(below_reads)+
+                                     ["Below base majority"]*np.sum(below_majority)+
+                                     ["Discordant genotype"]*np.sum(discordant), dtype=object)
+
+    ## .out sorted by haplogroup in the same (not stable) order as pandas sort_values
+    out_rows = called[passed]
+    out_order = np.asarray(table["haplogroup"][out_rows], dtype=object).argsort(kind="quicksort")
+    df_out = dict((i, table[i][out_rows][out_order]) for i in MarkerDatabase.columns+["reads"])
+    df_out["called_perc"] = called_perc[passed][out_order]
+    df_out["called_base"] = called_base[passed][out_order]
+    df_out["state"] = state[passed][out_order]
+
+    log_output_list.append("Valid markers: "+str(len(reads))) #valid markers provided
+    log_output_list.append("Markers with zero reads: "+str(n_belowzero)) 
+    log_output_list.append("Markers below the read threshold {"+str(Reads_thresh)+"}: "+str(np.sum(below_reads))) 
+    log_output_list.append("Markers below the base majority threshold {"+str(Base_majority)+"}: "+str(np.sum(below_majority))) 
+    log_output_list.append("Markers with discordant genotype: "+str(np.sum(discordant))) 
+    log_output_list.append("Markers without haplogroup information: "+str(len(fmf_rows))) 
+    log_output_list.append("Markers with haplogroup information: "+str(len(out_rows))) 
+    if Max_depth:
+        log_output_list.append("Sites with depth capped at {"+str(Max_depth)+"} reads: "+str(n_capped)) 
+    metrics.stop(stage, len(reads))
+
+    stage = metrics.start("write")
+    with open(log_output, "a") as log:
+        for marker in log_output_list:
+            log.write(marker)
+            log.write("\n")
+
+    columns_fmf = MarkerDatabase.columns+["reads","called_perc","called_base","state","Description"]
+    columns_out = ["chr","pos","marker_name","haplogroup","mutation","anc","der","reads","called_perc","called_base","state"]
+    if Binary:
+        predict_haplogroup.write_call_table(pd.DataFrame(collections.OrderedDict((i, df_fmf[i]) for i in columns_fmf)), 
+                                            fmf_output+".npz")
+        predict_haplogroup.write_call_table(pd.DataFrame(collections.OrderedDict((i, df_out[i]) for i in columns_out)), 
+                                            Outputfile+".npz")
+    else:
+        write_table(columns_fmf, df_fmf, fmf_output)
+        write_table(columns_out, df_out, Outputfile)
+    metrics.stop(stage, len(out_rows)+len(fmf_rows))
+    return df_out
+
+def extract_haplogroups_light(path_Markerfile, Reads_thresh, Base_majority, 
+                              counts, log_output, fmf_output, Outputfile, total_pileup=None, Binary=False, 
+                              Max_depth=0):
+    """
+    extract_haplogroups on the base counts as NumPy columns, writes the same 
+    .log, .fmf and .out files and returns the .out columns
+    """
+    print("Extracting haplogroups...")
+    counts = get_count_columns(counts)
+    if total_pileup is None:
+        total_pileup = len(counts["pos"])
+    
+    markers = load_marker_database(path_Markerfile)
+    ## rows of the markers and of their pileup line, sorted by position
+    rows = markers.lookup(counts["pos"])
+    order = np.argsort(rows[rows >= 0], kind="stable")
+    pileup_rows = np.flatnonzero(rows >= 0)[order]
+    table = dict((i, markers.table[i][rows[pileup_rows]]) for i in MarkerDatabase.columns)
+    table["reads"] = np.asarray(counts["reads"])[pileup_rows]
+    freq_table = np.column_stack([np.asarray(counts[i])[pileup_rows] for i in ["A","T","G","C"]])
+    n_capped = np.sum(table["reads"] > Max_depth) if Max_depth else 0
+    called_base, called_perc, state, bool_state = call_states(freq_table, table["anc"], table["der"])
+    return write_sample_calls(table, called_base, called_perc, state, bool_state, Reads_thresh, Base_majority, 
+                              log_output, fmf_output, Outputfile, total_pileup, Binary, Max_depth, n_capped)
+
+def sweep_thresholds(path_Markerfile, Pileupfile, list_Reads_thresh, list_Base_majority, Max_depth=0, Seed=0):
+    """
+    Applies a grid of read and base majority thresholds to the called markers 
+    at once by broadcasting reads x majority x markers. Returns the called 
+    markers, the mask of markers kept for every threshold pair and the 
+    summary of the grid in long format (same counts as the .log)
+    """
+    df, df_belowzero, n_capped = call_markers(path_Markerfile, Pileupfile, Max_depth, Seed)
+    reads = df["reads"].values
+    called_perc = df["called_perc"].values
+    concordant = df["bool_state"].values.astype(bool)
+
+    below_reads = reads[np.newaxis,:] < np.array(list_Reads_thresh)[:,np.newaxis]
+    below_majority = called_perc[np.newaxis,:] < np.array(list_Base_majority)[:,np.newaxis]
+    passed = ~(below_reads[:,np.newaxis,:] | below_majority[np.newaxis,:,:] | ~concordant)
+
+    grid_reads, grid_majority = np.meshgrid(list_Reads_thresh, list_Base_majority, indexing="ij")
+    n_below_reads, n_below_majority = np.meshgrid(below_reads.sum(axis=1), below_majority.sum(axis=1), indexing="ij")
+    n_discordant = np.sum(~concordant)
+    df_sweep = pd.DataFrame({"Reads_thresh": grid_reads.ravel(), "Base_majority": grid_majority.ravel(), 
+                             "Zero_reads": len(df_belowzero), "Below_reads": n_below_reads.ravel(), 
+                             "Below_majority": n_below_majority.ravel(), "Discordant": n_discordant})
+    df_sweep["Without_hg"] = df_sweep[["Zero_reads","Below_reads","Below_majority","Discordant"]].sum(axis=1)
+    df_sweep["With_hg"] = passed.sum(axis=2).ravel()
+    return df, passed, df_sweep
+
+def write_sweep(path_Markerfile, Pileupfile, list_Reads_thresh, list_Base_majority, folder_name, sweep_folder, 
+                Max_depth=0, Seed=0):
+    """
+    Predicts the haplogroup of every threshold pair in memory and writes the 
+    sample summary of the grid with its predictions to sweep_folder
+    """
+    df, passed, df_sweep = sweep_thresholds(path_Markerfile, Pileupfile, list_Reads_thresh, list_Base_majority, 
+                                            Max_depth, Seed)
+    predictions = []
+    for i, j in np.ndindex(passed.shape[:2]):
+        grid_name = "{}_r{}_b{}".format(folder_name.replace(".","_"), list_Reads_thresh[i], list_Base_majority[j])
+        predictions.append(predict_haplogroup.predict_sample(get_out_table(df[passed[i,j]]), grid_name))
+    df_hg = pd.DataFrame(predictions, columns=predict_haplogroup.prediction_columns)
+    df_hg = df_hg.drop(["Sample_name"], axis=1)
+    df_sweep = pd.concat([df_sweep, df_hg], axis=1)
+    df_sweep.insert(0, "Sample_name", folder_name.split(".")[0])
+    df_sweep.to_csv(sweep_folder+"/"+folder_name+".sweep", sep="\t", index=False)
+
+def merge_sweep(sweep_folder, sweep_output):
+    """
+    Joins the grid summaries and haplogroup predictions of all samples into a 
+    single long format table
+    """
+    sweep_files = check_if_folder(sweep_folder,'.sweep')
+    if len(sweep_files) == 0:
+        return
+    df_sweep = pd.concat([pd.read_csv(i, sep="\t", dtype={"Sample_name":str}, keep_default_na=False) 
+                          for i in sweep_files], axis=0)
+    df_sweep = df_sweep.sort_values(by=["Sample_name","Reads_thresh","Base_majority"])
+    df_sweep.to_csv(sweep_output, sep="\t", index=False)
+
+def samtools(folder, folder_name, bam_file, Quality_thresh, Markerfile, Reads_thresh, Base_majority, 
+             Targeted=False, Stream=False, Engine="samtools", Cache=None, Sweep=None, 
+             Sort_threads=1, Sort_memory="2G", Tmp_dir=None, Binary=False, Profile=False, Light=False, 
+             Min_Y_reads=0, Min_Y_perc=0.0, Shards=1, Max_depth=0, Seed=0, Reference=None):
             
 
-    start_time = time.time()    
-    if not os.path.exists(bam_file+'.bai'): 
-        
-        bam_file_order = folder+"/"+folder_name+".order.bam"                        
-        cmd = "samtools sort -m 2G {} > {}".format(bam_file, bam_file_order)        
-        print("\tSorting Bam file...")        
-        subprocess.call(cmd, shell=True)
-        cmd = "samtools index {}".format(bam_file_order)        
-        subprocess.call(cmd, shell=True)                
-        bam_file = bam_file_order
-                    
-    file_name  = folder_name
+    sample_time = time.time()
+    metrics.reset(folder_name)
+    if Profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    manifest = get_manifest(bam_file, Markerfile, get_run_params(Quality_thresh, Reads_thresh, Base_majority, Targeted, Binary, 
+                                                                 Max_depth, Seed))
     Outputfile = folder+"/"+folder_name+".out"    
     log_output = folder+"/"+folder_name+".log"
     fmf_output = folder+"/"+folder_name+".fmf"
-    pileupfile = folder+"/"+folder_name+".pu" 
+    chr_output = folder+"/"+folder_name+".chr"
+    cache_file = None
+    if Cache:
+        cache_file = get_cache_file(Cache, folder_name, manifest, Engine)
 
-    header,total_reads = chromosome_table(bam_file,folder,file_name)
-    execute_mpileup(header, bam_file, pileupfile, Quality_thresh, folder)                      
+    start_time = time.time()    
+    try:
+        if cache_file and os.path.exists(cache_file):
+            print("\tUsing cached base counts "+cache_file)
+            with metrics.stage("read_cache") as stage:
+                df_counts, total_pileup = read_count_cache(cache_file, chr_output, Light)
+                stage["rows"] = len(df_counts["pos"])
+            triage_y_coverage(chr_output, Min_Y_reads, Min_Y_perc)
+        else:
+            df_counts, total_pileup = run_pileup(folder, folder_name, bam_file, Quality_thresh, Markerfile, 
+                                                 Targeted, Stream, Engine, Sort_threads, Sort_memory, Tmp_dir, Light, 
+                                                 Min_Y_reads, Min_Y_perc, Shards, Reference, Max_depth, Seed)
+            if cache_file:
+                with metrics.stage("write_cache") as stage:
+                    write_count_cache(cache_file, df_counts, total_pileup, chr_output)
+                    stage["rows"] = len(df_counts["pos"])
+    except InsufficientYCoverage as error:
+        print("\tInsufficient Y coverage: {}, skipping...".format(error))
+        with open(log_output, "a") as log:
+            log.write("Insufficient Y coverage: {}\n".format(error))
+        if Profile:
+            profiler.disable()
+            profiler.dump_stats(folder+"/"+folder_name+".prof")
+        return get_triage_record(folder_name.split(".")[0], error)
     print("--- %.2f seconds in run PileUp ---" % (time.time() - start_time))    
     
     start_time = time.time()            
-    extract_haplogroups(Markerfile, args.Reads_thresh, args.Base_majority, 
-                            pileupfile, log_output, fmf_output, Outputfile)
-    
-    cmd = "rm {};".format(pileupfile)
-    subprocess.call(cmd, shell=True)                
+    if Light:
+        out = extract_haplogroups_light(Markerfile, Reads_thresh, Base_majority, 
+                                        df_counts, log_output, fmf_output, Outputfile, total_pileup, Binary, 
+                                        Max_depth)
+        with metrics.stage("prediction") as stage:
+            prediction = predict_haplogroup.predict_markers(out["marker_name"], out["haplogroup"], out["state"], 
+                                                            folder_name.split(".")[0])
+            stage["rows"] = len(out["pos"])
+    else:
+        df_out = extract_haplogroups(Markerfile, Reads_thresh, Base_majority, 
+                                     df_counts, log_output, fmf_output, Outputfile, total_pileup, Binary, 
+                                     Max_depth, Seed)
+        with metrics.stage("prediction") as stage:
+            prediction = predict_haplogroup.predict_sample(df_out, folder_name.split(".")[0])
+            stage["rows"] = len(df_out)
+    if Sweep:
+        list_Reads_thresh, list_Base_majority, sweep_folder = Sweep
+        with metrics.stage("sweep") as stage:
+            write_sweep(Markerfile, pd.DataFrame(df_counts), list_Reads_thresh, list_Base_majority, folder_name, sweep_folder, 
+                        Max_depth, Seed)
+            stage["rows"] = len(list_Reads_thresh)*len(list_Base_majority)
         
     print("--- %.2f seconds in extracting haplogroups --- " % (time.time() - start_time) )
-    print("--- %.2f seconds to run Clean tree  ---" % (time.time() - whole_time))
+    print("--- %.2f seconds to run Clean tree  ---" % (time.time() - sample_time))
+    write_manifest(folder, folder_name, manifest)
+    if Profile:
+        profiler.disable()
+        profiler.dump_stats(folder+"/"+folder_name+".prof")
     
-    return Outputfile
+    return prediction
+
+def run_pileup(folder, folder_name, bam_file, Quality_thresh, Markerfile, Targeted=False, Stream=False, 
+               Engine="samtools", Sort_threads=1, Sort_memory="2G", Tmp_dir=None, Light=False, 
+               Min_Y_reads=0, Min_Y_perc=0.0, Shards=1, Reference=None, Max_depth=0, Seed=0):
+    """
+    Sorts and indexes the BAM file if needed, writes the .chr table and returns 
+    the base counts of the marker positions with the number of pileup lines 
+    (as NumPy columns with Light and the pysam engine). Raises 
+    InsufficientYCoverage before the pileup when chromosome Y has too few reads
+    """
+    bam_file = prepare_bam(folder, folder_name, bam_file, Engine, Sort_threads, Sort_memory, Tmp_dir, Reference)
+                    
+    pileupfile = folder+"/"+folder_name+".pu" 
+    bed_file   = None
+
+    with metrics.stage("idxstats") as stage:
+        header,total_reads = chromosome_table(bam_file,folder,folder_name,Engine,Reference)
+        stage["rows"] = total_reads
+    triage_y_coverage(folder+"/"+folder_name+".chr", Min_Y_reads, Min_Y_perc)
+    if Targeted and Engine == "samtools":
+        bed_file = folder+"/"+folder_name+".bed"
+        write_marker_bed(Markerfile, header, bed_file)
+    if Shards > 1:
+        with metrics.stage("mpileup") as stage: # pileup and counting of the shards run together
+            df_counts, total_pileup = run_sharded_pileup(bam_file, header, Markerfile, Quality_thresh, Shards, 
+                                                         bed_file, Engine, Light, Targeted, Reference, Max_depth, Seed)
+            stage["rows"] = total_pileup
+    elif Engine == "pysam":
+        with metrics.stage("mpileup") as stage:
+            if Light:
+                df_counts = pysam_count_columns(bam_file, header, get_marker_positions(Markerfile), Quality_thresh, Reference, 
+                                                Max_depth, Seed)
+            else:
+                df_counts = pysam_counts(bam_file, header, get_marker_positions(Markerfile), Quality_thresh, Reference, 
+                                         Max_depth, Seed)
+            total_pileup = stage["rows"] = len(df_counts["pos"])
+    else:
+        if Stream:
+            with metrics.stage("mpileup") as stage: # samtools and parsing run together on the stream
+                positions = set(get_marker_positions(Markerfile))
+                Pileupfile, total_pileup = read_pileup_stream(header, bam_file, Quality_thresh, positions, bed_file, Reference)
+                stage["rows"] = total_pileup
+        else:
+            with metrics.stage("mpileup"):
+                execute_mpileup(header, bam_file, pileupfile, Quality_thresh, folder, bed_file, Reference)                      
+            with metrics.stage("parse") as stage:
+                Pileupfile = read_pileup(pileupfile)
+                total_pileup = stage["rows"] = len(Pileupfile)
+            cmd = "rm {};".format(pileupfile)
+            subprocess.call(cmd, shell=True)                
+        with metrics.stage("frequency_table") as stage:
+            df_counts = get_marker_counts(Markerfile, Pileupfile, Max_depth, Seed)
+            stage["rows"] = len(df_counts)
+    if bed_file:
+        cmd = "rm {};".format(bed_file)
+        subprocess.call(cmd, shell=True)
+    return df_counts, total_pileup
 
-def identify_haplogroup(app_folder, path_file, output):
+def get_shards(positions, Shards, length, window_sizes=None, Targeted=False):
+    """
+    Splits the sorted marker positions into at most Shards contiguous regions 
+    of about the same pileup cost. The cost is the number of markers, 
+    weighted by the reads of their 16 kb window (Targeted) or of the windows 
+    since the previous marker (whole chromosome) when window_sizes is known. 
+    The regions cover the whole chromosome without overlap. Returns 
+    (start, end, positions) of every shard
+    """
+    cost = np.ones(len(positions))
+    if window_sizes is not None and len(positions) > 0:
+        windows = np.minimum((positions-1) >> 14, len(window_sizes)-1)
+        if Targeted:
+            cost += window_sizes[windows]
+        else:
+            cumulative = np.cumsum(window_sizes)[windows]
+            cost += np.diff(cumulative, prepend=0)
+            cost[-1] += np.sum(window_sizes) - cumulative[-1]
+    cumulative = np.cumsum(cost)
+    splits = np.searchsorted(cumulative, cumulative[-1]*np.arange(1, Shards)/Shards) if len(positions) else []
+    splits = np.unique(np.concatenate([[0], np.asarray(splits, dtype=np.int64)+1, [len(positions)]]))
+    shards = []
+    for first, last in zip(splits[:-1], splits[1:]):
+        if first == last:
+            continue
+        start = 1 if first == 0 else positions[first-1]+1
+        end = length if last == len(positions) else positions[last-1]
+        shards.append((int(start), int(end), positions[first:last]))
+    return shards
+
+def run_shard(job):
+    """
+    Pileup and base counts of the marker positions of one region
+    """
+    bam_file, header, start, end, positions, Quality_thresh, Markerfile, bed_file, Engine, Light, Reference, Max_depth, Seed = job
+    if Engine == "pysam":
+        df_counts = pysam_count_columns(bam_file, header, positions, Quality_thresh, Reference, Max_depth, Seed)
+        if not Light:
+            df_counts = pd.DataFrame(df_counts)
+        return df_counts, len(df_counts["pos"])
+    region = "{}:{}-{}".format(header, start, end)
+    Pileupfile, total_pileup = read_pileup_stream(region, bam_file, Quality_thresh, set(positions), bed_file, Reference)
+    return get_marker_counts(Markerfile, Pileupfile, Max_depth, Seed), total_pileup
+
+def run_sharded_pileup(bam_file, header, Markerfile, Quality_thresh, Shards, bed_file=None, 
+                       Engine="samtools", Light=False, Targeted=False, Reference=None, Max_depth=0, Seed=0):
+    """
+    Runs the pileup of the regions of get_shards in parallel and joins their 
+    base counts in position order, the same as a single pileup of the 
+    chromosome. Worker processes of -j run their shards in threads
+    """
+    length = dict((row[0], row[1]) for row in index_statistics(bam_file, Engine, Reference)).get(header, 0)
+    positions = get_marker_positions(Markerfile)
+    shards = get_shards(positions, Shards, max(length, positions[-1] if len(positions) else 0), 
+                        get_window_sizes(bam_file, header), Targeted or Engine == "pysam")
+    jobs = [(bam_file, header, start, end, shard_positions, Quality_thresh, Markerfile, bed_file, Engine, Light, Reference, 
+             Max_depth, Seed) for start, end, shard_positions in shards]
+    if len(jobs) <= 1:
+        return run_shard((bam_file, header, 1, max(length, 1), positions, Quality_thresh, Markerfile, bed_file, 
+                          Engine, Light, Reference, Max_depth, Seed))
+    if multiprocessing.current_process().daemon: # processes of a pool can not have children
+        pool = multiprocessing.pool.ThreadPool(processes=len(jobs))
+    else:
+        pool = multiprocessing.Pool(processes=len(jobs))
+    try:
+        results = pool.map(run_shard, jobs, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    total_pileup = sum(shard_pileup for shard_counts, shard_pileup in results)
+    if isinstance(results[0][0], dict):
+        df_counts = collections.OrderedDict((i, np.concatenate([shard_counts[i] for shard_counts, shard_pileup in results]))
+                                            for i in results[0][0])
+    else:
+        df_counts = pd.concat([shard_counts for shard_counts, shard_pileup in results], axis=0, ignore_index=True)
+    return df_counts, total_pileup
+
+def find_bam_index(bam_file):
+    """
+    Returns the index of a BAM or CRAM file (file.bam.bai, file.bam.csi, 
+    file.bai, file.cram.crai or file.crai), None if there is none
+    """
+    if bam_file.endswith(".cram"):
+        indexes = [bam_file+".crai", os.path.splitext(bam_file)[0]+".crai"]
+    else:
+        indexes = [bam_file+".bai", bam_file+".csi", os.path.splitext(bam_file)[0]+".bai"]
+    for index in indexes:
+        if os.path.exists(index):
+            return index
+    return None
+
+def get_sort_order(bam_file, Engine="samtools"):
+    """
+    Sort order (SO) of the @HD line of the BAM header, unknown if missing
+    """
+    if Engine == "pysam":
+        with open_alignment_file(bam_file) as bam:
+            return bam.header.to_dict().get("HD", {}).get("SO", "unknown")
+    header = subprocess.check_output(["samtools", "view", "-H", bam_file], universal_newlines=True)
+    for line in header.splitlines():
+        if line.startswith("@HD"):
+            for field in line.split("\t")[1:]:
+                if field.startswith("SO:"):
+                    return field[3:]
+    return "unknown"
+
+def prepare_bam(folder, folder_name, bam_file, Engine="samtools", Sort_threads=1, Sort_memory="2G", Tmp_dir=None, 
+                Reference=None):
+    """
+    Makes sure the BAM (or CRAM) file is sorted and indexed. An existing index 
+    is used as it is, a coordinate sorted file is only indexed (through a link 
+    in the sample folder) and any other file is sorted first (to BAM)
+    """
+    if find_bam_index(bam_file):
+        return bam_file
+
+    if get_sort_order(bam_file, Engine) == "coordinate":
+        print("\tIndexing Bam file...")
+        bam_file_link = folder+"/"+folder_name+os.path.splitext(bam_file)[1]
+        if not os.path.exists(bam_file_link):
+            os.symlink(os.path.abspath(bam_file), bam_file_link)
+        bam_file = bam_file_link
+    else:
+        bam_file_order = folder+"/"+folder_name+".order.bam"                        
+        tmp_prefix = os.path.join(Tmp_dir or folder, folder_name+".sort")
+        print("\tSorting Bam file...")        
+        with metrics.stage("sort"):
+            options = get_reference_options(bam_file, Reference)
+            if Engine == "pysam":
+                pysam.sort(*(options+["-@", str(Sort_threads), "-m", Sort_memory, "-T", tmp_prefix, "-o", bam_file_order, bam_file]))
+            else:
+                cmd = "samtools sort {} -@ {} -m {} -T {} -o {} {}".format(" ".join(options), Sort_threads, Sort_memory, 
+                                                                          tmp_prefix, bam_file_order, bam_file)        
+                subprocess.call(cmd, shell=True)
+        bam_file = bam_file_order
+
+    with metrics.stage("index"):
+        if Engine == "pysam":
+            pysam.index(bam_file)
+        else:
+            cmd = "samtools index {}".format(bam_file)        
+            subprocess.call(cmd, shell=True)                
+    return bam_file
+
+def get_marker_counts(path_Markerfile, Pileupfile, Max_depth=0, Seed=0):
+    """
+    Keeps the pileup rows of the marker positions and replaces the pileup 
+    strings by their A,T,G,C,+,- counts (of Max_depth reads drawn at random)
+    """
+    bases = ["A","T","G","C","+","-"]
+    Pileupfile = Pileupfile.loc[load_marker_database(path_Markerfile).contains(Pileupfile['pos'].values)]
+    counts = np.zeros((len(Pileupfile), len(bases)), dtype=np.int64)
+    covered = Pileupfile["reads"].values > 0
+    counts[covered] = count_pileup_bases(Pileupfile["align"].values[covered], Max_depth, 
+                                         Pileupfile["pos"].values[covered], Seed)
+    df_counts = Pileupfile[['chr', 'pos', 'refbase', 'reads']].reset_index(drop=True)
+    df_counts[bases] = counts
+    return df_counts
+
+def get_cache_file(Cache, folder_name, manifest, Engine="samtools"):
+    """
+    Cache file of the base counts, named after the BAM content, quality 
+    threshold, depth cap, marker file and pileup engine (the number of 
+    pileup lines differs by engine) so a stale cache is never reused
+    """
+    key = ["bam_size", "bam_checksum", "marker_md5", "Quality_thresh", "Targeted"] + (["Max_depth", "Seed"] if "Max_depth" in manifest else [])
+    key = dict((i, manifest[i]) for i in key)
+    key["Engine"] = Engine
+    key = json.dumps(key, sort_keys=True)
+    if not os.path.isdir(Cache):
+        os.makedirs(Cache)
+    return os.path.join(Cache, folder_name+"."+hashlib.md5(key.encode()).hexdigest()+".npz")
+
+def write_count_cache(cache_file, df_counts, total_pileup, chr_output):
+
+    with open(chr_output) as f:
+        chr_table = f.read()
+    tmp_file = cache_file+".tmp.npz"
+    counts = [np.asarray(df_counts[i]) for i in ["reads","A","T","G","C","+","-"]]
+    np.savez_compressed(tmp_file, 
+                        chr=np.asarray(df_counts["chr"], dtype=str), pos=np.asarray(df_counts["pos"]),
+                        counts=np.column_stack(counts).astype(np.int32),
+                        total_pileup=total_pileup, chr_table=chr_table)
+    os.replace(tmp_file, cache_file)
+
+def read_count_cache(cache_file, chr_output, Light=False):
+
+    with np.load(cache_file) as cache:
+        df_counts = collections.OrderedDict([("chr", cache["chr"].astype(object)), ("pos", cache["pos"])])
+        for i, column in enumerate(["reads","A","T","G","C","+","-"]):
+            df_counts[column] = cache["counts"][:,i]
+        if not Light:
+            df_counts = pd.DataFrame(df_counts)
+        total_pileup = int(cache["total_pileup"])
+        chr_table = str(cache["chr_table"])
+    with open(chr_output, "w") as f:
+        f.write(chr_table)
+    return df_counts, total_pileup
+
+def get_run_params(Quality_thresh, Reads_thresh, Base_majority, Targeted, Binary=False, Max_depth=0, Seed=0):
     
-    script = app_folder+"/predict_haplogroup.py"
-    cmd = "python {} -input {} -out {}".format(script, path_file, output)    
-    print(cmd)
-    subprocess.call(cmd, shell=True)                    
+    params = {"Quality_thresh": Quality_thresh, "Reads_thresh": Reads_thresh, 
+              "Base_majority": Base_majority, "Targeted": Targeted}
+    if Binary:
+        params["Binary"] = Binary
+    if Max_depth:
+        params["Max_depth"] = Max_depth
+        params["Seed"] = Seed
+    return params
+
+def get_triage_record(sample_name, error):
+    """
+    Prediction record of a sample skipped by the Y coverage triage
+    """
+    prediction = collections.OrderedDict((i, "NA") for i in predict_haplogroup.prediction_columns)
+    prediction["Sample_name"] = sample_name
+    prediction["Status"] = error.status
+    prediction["Y_reads"] = error.y_reads
+    prediction["Y_perc"] = error.y_perc
+    return prediction
+
+def write_triage(predictions, triage_output):
+    """
+    Lists the samples skipped by the Y coverage triage
+    """
+    with open(triage_output, "w") as f:
+        f.write("Sample_name\tY_reads\tY_perc\tStatus\n")
+        for prediction in predictions:
+            f.write("{}\t{}\t{}\t{}\n".format(prediction["Sample_name"], prediction["Y_reads"], 
+                                             prediction["Y_perc"], prediction["Status"]))
+
+def run_sample(job):
+    """
+    Runs samtools() for one sample of a batch. Errors are returned instead of 
+    raised so a failing BAM file does not stop the rest of the batch
+    """
+    try:
+        return job[2], samtools(*job), list(metrics.stages), None
+    except Exception as error:
+        return job[2], None, list(metrics.stages), repr(error)
+
+def run_plate(samples, Quality_thresh, Markerfile, Reads_thresh, Base_majority, Sort_threads=1, Sort_memory="2G", 
+              Tmp_dir=None, Binary=False, Min_Y_reads=0, Min_Y_perc=0.0, Max_depth=0, Seed=0, Reference=None):
+    """
+    Plate mode: prepares every BAM file, runs a single samtools mpileup of 
+    the marker positions over all of them and calls the markers of all 
+    samples at once (samples x markers arrays). samples are (folder, 
+    folder_name, bam_file), returns the same as run_samples
+    """
+    predictions = {}
+    stages = []
+    failed = []
+    manifests = {}
+    groups = collections.OrderedDict() # samples of every chromosome Y name
+    for folder, folder_name, bam_file in samples:
+        metrics.reset(folder_name)
+        try:
+            manifests[bam_file] = get_manifest(bam_file, Markerfile, 
+                                               get_run_params(Quality_thresh, Reads_thresh, Base_majority, True, Binary, 
+                                                              Max_depth, Seed))
+            sample_bam = prepare_bam(folder, folder_name, bam_file, "samtools", Sort_threads, Sort_memory, Tmp_dir, Reference)
+            with metrics.stage("idxstats") as stage:
+                header,total_reads = chromosome_table(sample_bam,folder,folder_name,"samtools",Reference)
+                stage["rows"] = total_reads
+            triage_y_coverage(folder+"/"+folder_name+".chr", Min_Y_reads, Min_Y_perc)
+            groups.setdefault(header, []).append((folder, folder_name, bam_file, sample_bam))
+        except InsufficientYCoverage as error:
+            print("\tInsufficient Y coverage of {}: {}, skipping...".format(folder_name, error))
+            with open(folder+"/"+folder_name+".log", "a") as log:
+                log.write("Insufficient Y coverage: {}\n".format(error))
+            predictions[bam_file] = get_triage_record(folder_name.split(".")[0], error)
+        except Exception as error:
+            failed.append((bam_file, repr(error)))
+        stages += metrics.stages
+
+    markers = load_marker_database(Markerfile)
+    for header, group in groups.items():
+        print("\tPileup of {} BAM files...".format(len(group)))
+        metrics.reset("plate")
+        bed_file = tempfile.mkstemp(prefix="clean_tree_plate", suffix=".bed")[1]
+        write_marker_bed(Markerfile, header, bed_file)
+        bam_files = [i[3] for i in group]
+        try:
+            with metrics.stage("mpileup") as stage:
+                positions, reads, counts = read_plate_pileup(header, bam_files, Quality_thresh, set(markers.positions), 
+                                                             bed_file, Reference, Max_depth, Seed)
+                stage["rows"] = len(positions)
+            ## samples without reads at a position of the plate: zero reads after the base quality filter or no reads at all
+            present = reads > 0
+            zero = np.flatnonzero(~present.all(axis=0))
+            if len(zero):
+                with metrics.stage("coverage") as stage:
+                    write_bed(positions[zero], header, bed_file)
+                    present[:, zero] = read_plate_coverage(header, bam_files, positions[zero], bed_file, Reference)
+                    stage["rows"] = len(zero)
+        except subprocess.CalledProcessError as error: # the pileup of every sample of the group is incomplete
+            failed += [(bam_file, repr(error)) for folder, folder_name, bam_file, sample_bam in group]
+            stages += metrics.stages
+            continue
+        finally:
+            os.remove(bed_file)
+        total_pileup = present.sum(axis=1)
+        with metrics.stage("filtering") as stage:
+            rows = markers.lookup(positions)
+            table = dict((i, markers.table[i][rows]) for i in MarkerDatabase.columns)
+            freq_table = counts[:,:,:4]
+            capped = reads > Max_depth if Max_depth else np.zeros(reads.shape, dtype=bool)
+            called_base, called_perc, state, bool_state = call_states(freq_table, table["anc"], table["der"])
+            stage["rows"] = reads.size
+        stages += metrics.stages
+
+        for i, (folder, folder_name, bam_file, sample_bam) in enumerate(group):
+            metrics.reset(folder_name)
+            print("Extracting haplogroups of {}...".format(folder_name))
+            covered = present[i] # the pileup lines of this sample alone
+            sample_table = dict((column, table[column][covered]) for column in MarkerDatabase.columns)
+            sample_table["reads"] = reads[i][covered]
+            out = write_sample_calls(sample_table, called_base[i][covered], called_perc[i][covered], state[i][covered], 
+                                     bool_state[i][covered], Reads_thresh, Base_majority, 
+                                     folder+"/"+folder_name+".log", folder+"/"+folder_name+".fmf", 
+                                     folder+"/"+folder_name+".out", total_pileup[i], Binary, 
+                                     Max_depth, np.sum(capped[i][covered]))
+            with metrics.stage("prediction") as stage:
+                predictions[bam_file] = predict_haplogroup.predict_markers(out["marker_name"], out["haplogroup"], 
+                                                                           out["state"], folder_name.split(".")[0])
+                stage["rows"] = len(out["pos"])
+            write_manifest(folder, folder_name, manifests[bam_file])
+            stages += metrics.stages
+    for bam_file, error in failed:
+        print("WARNING! Sample {} failed: {}".format(bam_file, error))
+    return predictions, stages, failed
+
+def run_samples(jobs, Jobs):
+    """
+    Processes the samples sequentially or with a pool of Jobs processes, 
+    returns the haplogroup prediction of every BAM file, the stage metrics of 
+    all samples and the list of samples that failed
+    """
+    if Jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(Jobs, len(jobs)))
+        results = pool.map(run_sample, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [run_sample(job) for job in jobs]
+    predictions = dict((bam_file, prediction) for bam_file, prediction, sample_stages, error in results if error is None)
+    stages = [record for bam_file, prediction, sample_stages, error in results for record in sample_stages]
+    failed = [(bam_file, error) for bam_file, prediction, sample_stages, error in results if error is not None]
+    for bam_file, error in failed:
+        print("WARNING! Sample {} failed: {}".format(bam_file, error))
+    return predictions, stages, failed
     
 if __name__ == "__main__":
             
-    whole_time = time.time()
     print("\tErasmus MC Department of Genetic Identification \n\n\tClean tree 2.0 \n")
 
     args = get_arguments()    
+    if args.Engine == "pysam" and pysam is None:
+        print("ERROR! The pysam engine requires the pysam package (pip install pysam)")
+        exit(1)
+    if args.Plate:
+        if args.Engine == "pysam":
+            print("ERROR! -plate uses a single samtools mpileup, it can not be used with -e pysam")
+            exit(1)
+        if args.Cache or args.Sweep_reads or args.Sweep_majority or args.Shards > 1:
+            print("WARNING! -cache, -sweep_r, -sweep_b and -shards are not used with -plate")
+            args.Cache, args.Sweep_reads, args.Sweep_majority, args.Shards = None, None, None, 1
+        args.Targeted = True
+    load_marker_database(args.position) # parsed once and shared with the worker processes
     app_folder = os.path.dirname(os.path.realpath(__file__))    
     sam_file    = ''
     folder_name = ''                
@@ -424,18 +1945,69 @@ if __name__ == "__main__":
             out_folder = out_path
         else:
             out_folder = cwd+"/"+out_path        
-    if create_tmp_dirs(out_folder):        
+    params = get_run_params(args.Quality_thresh, args.Reads_thresh, args.Base_majority, args.Targeted, args.Binary, 
+                            args.Max_depth, args.Seed)
+    out_ext = ".out.npz" if args.Binary else ".out"
+    if create_tmp_dirs(out_folder, args.Force, args.Resume):        
         if args.Bamfile:                
-                files = check_if_folder(args.Bamfile,'.bam')
-                for path_file in files:            
-                    print("Starting...")
-                    print(path_file)
-                    bam_file = path_file
-                    folder_name = get_folder_name(path_file)
-                    folder = os.path.join(app_folder,out_folder,folder_name)                            
-                    if create_tmp_dirs(folder):                                            
-                        output_file = samtools(folder, folder_name, bam_file, args.Quality_thresh, args.position)                        
-                hg_out = out_folder+"/"+out_path+".hg"
-                identify_haplogroup(app_folder, out_folder, hg_out)                                                                        
+                files = check_if_folder(args.Bamfile,('.bam','.cram'))
+                if any(i.endswith(".cram") for i in files) and not args.Reference:
+                    print("ERROR! CRAM files need the reference FASTA they were compressed with (-ref)")
+                    exit(1)
+                sweep = None
+                if args.Sweep_reads or args.Sweep_majority:
+                    sweep = (args.Sweep_reads or [args.Reads_thresh], args.Sweep_majority or [args.Base_majority], 
+                             tempfile.mkdtemp(prefix="clean_tree_sweep"))
+                try:
+                    jobs = []
+                    predictions = collections.OrderedDict()
+                    out_files = {}
+                    for path_file in files:            
+                        print("Starting...")
+                        print(path_file)
+                        bam_file = path_file
+                        folder_name = get_folder_name(path_file)
+                        folder = os.path.join(app_folder,out_folder,folder_name)                            
+                        out_files[bam_file] = folder+"/"+folder_name+out_ext
+                        if args.Resume and not sweep and sample_is_complete(folder, folder_name, 
+                                                              get_manifest(bam_file, args.position, params)):
+                            print("\tAlready processed, skipping...")
+                            predictions[bam_file] = predict_haplogroup.predict_file(out_files[bam_file])
+                            continue
+                        if create_tmp_dirs(folder, args.Force or args.Resume):                                            
+                            jobs.append((folder, folder_name, bam_file, args.Quality_thresh, args.position, 
+                                         args.Reads_thresh, args.Base_majority, args.Targeted, args.Stream, args.Engine, 
+                                         args.Cache, sweep, args.Sort_threads, args.Sort_memory, args.Tmp_dir, args.Binary, 
+                                         args.Profile, args.Light, args.Min_Y_reads, args.Min_Y_perc, args.Shards, 
+                                         args.Max_depth, args.Seed, args.Reference))
+                            predictions[bam_file] = None
+                    if args.Plate:
+                        sample_predictions, stages, failed = run_plate([job[:3] for job in jobs], args.Quality_thresh, 
+                                                                       args.position, args.Reads_thresh, args.Base_majority, 
+                                                                       args.Sort_threads, args.Sort_memory, args.Tmp_dir, 
+                                                                       args.Binary, args.Min_Y_reads, args.Min_Y_perc, 
+                                                                       args.Max_depth, args.Seed, args.Reference)
+                    else:
+                        sample_predictions, stages, failed = run_samples(jobs, args.Jobs)
+                    predictions.update(sample_predictions)
+                    write_metrics(stages, out_folder+"/"+out_path+".metrics")
+                    hg_out = out_folder+"/"+out_path+".hg"
+                    if os.path.exists(hg_out):
+                        os.remove(hg_out)
+                    print("\tY-Haplogroup Prediction")
+                    predict_haplogroup.write_predictions([i for i in predictions.values() if i is not None], hg_out)
+                    triaged = [i for i in predictions.values() if i is not None and "Status" in i]
+                    if triaged:
+                        print("\t{} samples with insufficient Y coverage".format(len(triaged)))
+                        write_triage(triaged, out_folder+"/"+out_path+".triage")
+                    called = [i for i in predictions if predictions[i] is not None and "Status" not in predictions[i]]
+                    if args.Binary and called:
+                        predict_haplogroup.write_cohort_table([(predictions[i]["Sample_name"], predict_haplogroup.read_call_table(out_files[i])) 
+                                                               for i in called], out_folder+"/"+out_path+".cohort.npz")
+                    if sweep:
+                        merge_sweep(sweep[2], out_folder+"/"+out_path+".sweep")
+                finally:
+                    if sweep:
+                        shutil.rmtree(sweep[2])
     else:
         print("--- Clean tree finished... ---")
\ No newline at end of file
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017-2019 Diego Montiel Gonzalez
+# Erasmus Medical Center
+# Department of Genetic Identification
+#
+# License: GNU General Public License v3 or later
+# A copy of GNU GPL v3 should have been included in this software package in LICENSE.txt.
+
+# Script for the cohort marker x sample matrix of Clean treev2
+
+import pandas as pd
+import numpy as np
+import os
+from argparse import ArgumentParser
+import predict_haplogroup
+
+NA, ANCESTRAL, DERIVED = 0, 1, 2
+state_codes = {"A": ANCESTRAL, "D": DERIVED}
+
+def get_arguments():
+
+    parser = ArgumentParser(description="Erasmus MC: Genetic Identification\n Cohort marker x sample matrix")
+
+    parser.add_argument("-input", "--Input",
+        dest="Input", required=True, type=predict_haplogroup.file_exists,
+        help="Folder with .out/.out.npz files or a .cohort.npz file produced from Clean tree", metavar="FILE")
+
+    parser.add_argument("-out", "--Outfile",
+            dest="Outputfile", required=True,
+            help="Output prefix, writes <out>.matrix.npz, <out>.markers, <out>.samples and <out>.haplogroups", metavar="FILE")
+
+    parser.add_argument("-derived", "--Derived",
+            help="Print the samples derived for these markers",
+            nargs="+", required=False, metavar="MARKER")
+
+    args = parser.parse_args()
+    return args
+
+class CohortMatrix(object):
+    """
+    State of every marker (rows) in every sample (columns) coded as int8:
+    0 not called (NA), 1 ancestral, 2 derived
+    """
+    def __init__(self, markers, samples, matrix):
+        self.markers = markers.reset_index(drop=True)
+        self.samples = np.asarray(samples)
+        self.matrix = matrix
+        self.marker_rows = dict((marker_name, i) for i, marker_name in enumerate(self.markers["marker_name"].values))
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Builds the matrix from pairs of sample name and called markers (.out table)
+        """
+        samples = [sample_name for sample_name, df in tables]
+        columns = ["pos","marker_name","haplogroup","state"]
+        df_cohort = pd.DataFrame(dict((column, np.concatenate([df[column].values for sample_name, df in tables]))
+                                      for column in columns))
+        df_cohort["sample"] = np.repeat(np.arange(len(tables)), [len(df) for sample_name, df in tables])
+        df_cohort = df_cohort[df_cohort["state"].isin(list(state_codes))]
+        df_markers = df_cohort[["pos","marker_name","haplogroup"]].drop_duplicates("marker_name")
+        df_markers = df_markers.sort_values(by=["pos","marker_name"]).reset_index(drop=True)
+        rows = pd.Index(df_markers["marker_name"].values).get_indexer(df_cohort["marker_name"].values)
+        matrix = np.zeros((len(df_markers), len(samples)), dtype=np.int8)
+        matrix[rows, df_cohort["sample"].values] = df_cohort["state"].map(state_codes).values
+        return cls(df_markers, samples, matrix)
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as cohort:
+            markers = pd.DataFrame({"pos": cohort["pos"], "marker_name": cohort["marker_name"].astype(object),
+                                    "haplogroup": cohort["haplogroup"].astype(object)})
+            return cls(markers, cohort["samples"].astype(object), cohort["matrix"])
+
+    def save(self, path):
+
+        tmp_file = path+".tmp.npz"
+        np.savez_compressed(tmp_file, matrix=self.matrix, samples=np.array(self.samples, dtype=str),
+                            pos=self.markers["pos"].values,
+                            marker_name=self.markers["marker_name"].to_numpy(dtype=str),
+                            haplogroup=self.markers["haplogroup"].to_numpy(dtype=str))
+        os.replace(tmp_file, path)
+
+    def samples_with_state(self, marker_name, state=DERIVED):
+
+        row = self.marker_rows.get(marker_name)
+        if row is None:
+            return self.samples[:0]
+        return self.samples[self.matrix[row] == state]
+
+    def derived_samples(self, marker_name):
+
+        return self.samples_with_state(marker_name, DERIVED)
+
+    def marker_summary(self):
+        """
+        Number of samples called ancestral or derived and call rate of every marker
+        """
+        df = self.markers.copy()
+        df["ancestral"] = np.sum(self.matrix == ANCESTRAL, axis=1)
+        df["derived"] = np.sum(self.matrix == DERIVED, axis=1)
+        df["called"] = df["ancestral"] + df["derived"]
+        df["call_rate"] = np.round(df["called"] / max(len(self.samples), 1), 3)
+        return df
+
+    def sample_summary(self):
+        """
+        Number of markers called and call rate of every sample
+        """
+        called = np.sum(self.matrix != NA, axis=0)
+        return pd.DataFrame({"sample": self.samples, "called": called,
+                             "derived": np.sum(self.matrix == DERIVED, axis=0),
+                             "call_rate": np.round(called / max(len(self.markers), 1), 3)})
+
+    def haplogroup_summary(self):
+        """
+        Number of markers of every haplogroup and of samples with at least one
+        of them called or derived
+        """
+        haplogroups, codes = np.unique(self.markers["haplogroup"].to_numpy(dtype=str), return_inverse=True)
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(len(haplogroups)))
+        if len(order) == 0 or len(self.samples) == 0:
+            called = derived = np.zeros((len(haplogroups), len(self.samples)), dtype=bool)
+        else:
+            called = np.logical_or.reduceat(self.matrix[order] != NA, starts, axis=0)
+            derived = np.logical_or.reduceat(self.matrix[order] == DERIVED, starts, axis=0)
+        return pd.DataFrame({"haplogroup": haplogroups, "markers": np.bincount(codes, minlength=len(haplogroups)),
+                             "samples_called": called.sum(axis=1), "samples_derived": derived.sum(axis=1)})
+
+def load_tables(path):
+    """
+    Pairs of sample name and called markers of a .cohort.npz file or of all
+    .out/.out.npz files of a folder
+    """
+    if path.endswith(".cohort.npz"):
+        return list(predict_haplogroup.read_cohort_table(path).items())
+    samples = sorted(predict_haplogroup.check_if_folder(path, ('.out','.out.npz')))
+    return [(i.split("/")[-1].split(".")[0], predict_haplogroup.read_out_file(i)) for i in samples]
+
+if __name__ == "__main__":
+
+    print("\tCohort marker x sample matrix")
+
+    args = get_arguments()
+    tables = load_tables(args.Input)
+    if len(tables) == 0:
+        print("ERROR! No .out files found in "+args.Input)
+        exit(1)
+    cohort = CohortMatrix.from_tables(tables)
+    print("\t{} markers x {} samples".format(len(cohort.markers), len(cohort.samples)))
+    cohort.save(args.Outputfile+".matrix.npz")
+    cohort.marker_summary().to_csv(args.Outputfile+".markers", sep="\t", index=False)
+    cohort.haplogroup_summary().to_csv(args.Outputfile+".haplogroups", sep="\t", index=False)
+    cohort.sample_summary().to_csv(args.Outputfile+".samples", sep="\t", index=False)
+    for marker_name in args.Derived or []:
+        print("{}\t{}".format(marker_name, ",".join(cohort.derived_samples(marker_name))))
+    print("--- Clean tree 'Cohort matrix' finished... ---")
@@ -9,13 +9,37 @@
 
 # Script for Haplogroup prediction Clean treev2
 
-import pandas as pd
 import numpy as np
 import collections
+import numbers
+import importlib
+import csv
 import operator
 import os
+import bisect
+import json
+import multiprocessing
 from argparse import ArgumentParser
 
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported the first time one of its 
+    attributes is used, runs that never need it do not pay for its import
+    """
+    def __init__(self, name, on_import=None):
+        self.name = name
+        self.module = None
+        self.on_import = on_import
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+            if self.on_import is not None:
+                self.on_import(self.module)
+        return getattr(self.module, attr)
+
+pd = LazyModule("pandas")
+
 def get_arguments():
 
     parser = ArgumentParser(description="Erasmus MC: Genetic Identification\n Y-Haplogroup Prediction")    
@@ -27,6 +51,18 @@ def get_arguments():
     parser.add_argument("-out", "--Outfile",
             dest="Outputfile", required=True,                        
             help="Output file name", metavar="FILE")        
+
+    parser.add_argument("-j", "--Jobs",
+            help="Number of .out files predicted in parallel",
+            type=int, required=False, default=1)
+
+    parser.add_argument("-format", "--Format",
+            help="Output format: hg (appended table), tsv (table with one sample per line) or json (JSON lines)",
+            choices=["hg","tsv","json"], required=False, default="hg")
+
+    parser.add_argument("-cohort", "--Cohort",
+            dest="Cohort", required=False, default=None,
+            help="Also stores the called markers of all input samples in a single .cohort.npz file", metavar="FILE")
                    
     args = parser.parse_args()    
     return args
@@ -52,6 +88,167 @@ def check_if_folder(path,ext):
     else:
         return [path]
 
+def write_call_table(df, path):
+    """
+    Stores a call table (.out or .fmf) as .npz, text columns are kept as 
+    integer codes with a dictionary of their values (missing values and "NA" 
+    are -1). Numbers with "NA" (called_perc of the .fmf) are stored as floats 
+    with NaN, so both tables are read back with the dtypes of the text table
+    """
+    arrays = {"columns": np.array(df.columns, dtype=str)}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if values.dtype == object:
+            values = values.where(values != "NA")
+            if len(values) and all(isinstance(v, numbers.Number) for v in values.dropna()):
+                values = pd.to_numeric(values)
+        if values.dtype == object:
+            codes, categories = pd.factorize(values)
+            arrays["codes_{}".format(i)] = codes.astype(np.int32)
+            arrays["categories_{}".format(i)] = np.array(categories, dtype=str)
+        else:
+            arrays["values_{}".format(i)] = values.values
+    tmp_file = path+".tmp.npz"
+    np.savez_compressed(tmp_file, **arrays)
+    os.replace(tmp_file, path)
+
+def read_call_columns(path):
+    """
+    Columns of a call table written by write_call_table as NumPy arrays, text 
+    columns as object arrays with None for missing values
+    """
+    columns = collections.OrderedDict()
+    with np.load(path) as table:
+        for i, column in enumerate(table["columns"]):
+            if "codes_{}".format(i) in table:
+                codes = table["codes_{}".format(i)]
+                categories = np.append(table["categories_{}".format(i)].astype(object), None)
+                columns[str(column)] = categories[codes]
+            else:
+                columns[str(column)] = table["values_{}".format(i)]
+    return columns
+
+def read_call_table(path):
+    """
+    Reads a call table written by write_call_table
+    """
+    return pd.DataFrame(read_call_columns(path))
+
+def write_cohort_table(tables, path):
+    """
+    Stores the call tables of many samples (pairs of sample name and table) in 
+    a single .npz so a cohort is loaded with one read
+    """
+    df_cohort = pd.concat([df.assign(Sample_name=sample_name) for sample_name, df in tables], axis=0)
+    df_cohort = df_cohort[["Sample_name"]+[i for i in df_cohort.columns if i != "Sample_name"]]
+    write_call_table(df_cohort, path)
+
+def read_cohort_table(path):
+    """
+    Returns the call table of every sample of a .cohort.npz file, in the order 
+    they were stored
+    """
+    df_cohort = read_call_table(path)
+    tables = collections.OrderedDict()
+    for sample_name, df in df_cohort.groupby("Sample_name", sort=False):
+        tables[sample_name] = df.drop(["Sample_name"], axis=1).reset_index(drop=True)
+    return tables
+
+def read_out_file(sample_name):
+    """
+    Reads the called markers of a sample from a .out table or its .out.npz 
+    binary version
+    """
+    if sample_name.endswith(".npz"):
+        return read_call_table(sample_name)
+    return pd.read_csv(sample_name, sep="\t", engine='python')
+
+def read_out_columns(sample_name):
+    """
+    Columns of a .out table (or .out.npz) as NumPy arrays, without pandas
+    """
+    if sample_name.endswith(".npz"):
+        return read_call_columns(sample_name)
+    with open(sample_name) as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    columns = collections.OrderedDict()
+    for i, column in enumerate(rows[0] if rows else []):
+        columns[column] = np.array([row[i] for row in rows[1:]], dtype=object)
+    return columns
+
+class HaplogroupTree(object):
+    """
+    Prefix tree over the haplogroup names of the called markers of one sample 
+    (~ removed). A haplogroup is an ancestor of another when its name is a 
+    proper prefix of it (J2 -> J2a1), descendants are a range of the sorted names
+    """
+    def __init__(self, haplogroups):
+        self.names = sorted(set(hg.replace("~","") for hg in haplogroups))
+        self.known = set(self.names)
+
+    def get_ancestors(self, hg):
+        """
+        Names that are a proper prefix of hg, from the root down
+        """
+        hg = hg.replace("~","")
+        return [hg[:i] for i in range(1, len(hg)) if hg[:i] in self.known]
+
+    def get_descendants(self, hg):
+        """
+        Names that have hg as a proper prefix, sorted
+        """
+        hg = hg.replace("~","")
+        start = bisect.bisect_right(self.names, hg)
+        end = bisect.bisect_left(self.names, hg+"\U0010ffff")
+        return self.names[start:end]
+
+def read_columns(path, sep):
+    """
+    First and second column of a headerless table, blank lines are skipped 
+    and a missing second column is read as "nan"
+    """
+    first, second = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.strip() == "":
+                continue
+            fields = line.split(sep)
+            first.append(fields[0])
+            second.append(fields[1] if len(fields) > 1 and fields[1] != "" else "nan")
+    return np.array(first, dtype=object), np.array(second, dtype=str)
+
+class PredictionTables(object):
+    """
+    Intermediates.txt and every <root>_int.txt of Hg_Prediction_tables (names 
+    and expected states as arrays), read once per run and shared by all samples
+    """
+    def __init__(self, path_hg_prediction_tables):
+        self.intermediates = read_columns(path_hg_prediction_tables+"Intermediates.txt", ",")[0]
+        self.branches = {}
+        for table in sorted(os.listdir(path_hg_prediction_tables)):
+            if table.endswith("_int.txt"):
+                self.branches[table[:-len("_int.txt")]] = read_columns(path_hg_prediction_tables+table, "\t")
+
+prediction_tables = {}
+
+def load_prediction_tables(path_hg_prediction_tables):
+    """
+    Loads the prediction tables once per process
+    """
+    if path_hg_prediction_tables not in prediction_tables:
+        prediction_tables[path_hg_prediction_tables] = PredictionTables(path_hg_prediction_tables)
+    return prediction_tables[path_hg_prediction_tables]
+
+def group_markers(haplogroup):
+    """
+    Rows (positional) of the markers of every haplogroup
+    """
+    markers_by_hg = collections.OrderedDict()
+    for row, hg in enumerate(haplogroup):
+        markers_by_hg.setdefault(hg, []).append(row)
+    return dict((hg, np.array(rows, dtype=np.int64)) for hg, rows in markers_by_hg.items())
+
 def get_hg_root(hg):
     """
     Choose the haplogroup based on the highest count and branch depth (E.x. J2a21 = J)
@@ -74,38 +271,58 @@ def get_hg_root(hg):
         return init_hg
     
 def get_intermediate_branch(init_hg,path_hg_prediction_tables):
-    
-    tmp_init_hg = init_hg+"_int.txt"
-    hg_intermediate_file = path_hg_prediction_tables+tmp_init_hg
-    try:
-        df_intermediate = pd.read_csv(hg_intermediate_file, header=None, sep="\t", engine='python')
-        return df_intermediate
-    except:
-        return pd.DataFrame()
+    """
+    Names and expected states of the intermediate table of init_hg, None 
+    when there is no table
+    """
+    tables = load_prediction_tables(path_hg_prediction_tables)
+    return tables.branches.get(init_hg)
+
+def count_states(haplogroup, state):
+    """
+    Number of markers in A and D state and in total for every haplogroup, 
+    computed in a single pass per sample
+    """
+    hg_counts = {}
+    for (hg, hg_state), n in collections.Counter(zip(haplogroup, state)).items():
+        if hg not in hg_counts:
+            hg_counts[hg] = np.zeros(3, dtype=np.int64)
+        if hg_state == "A":
+            hg_counts[hg][0] += n
+        elif hg_state == "D":
+            hg_counts[hg][1] += n
+        hg_counts[hg][2] += n
+    return hg_counts
+
+def get_state_counts(hg_counts, names):
+    """
+    A, D and total counts (rows) of the haplogroups in names, zero for the 
+    ones without markers
+    """
+    zero = np.zeros(3, dtype=np.int64)
+    return np.array([hg_counts.get(i, zero) for i in names], dtype=np.int64).reshape(len(names), 3)
 
-def calc_score_one(df_intermediate,df_haplogroup):
+def calc_score_one(branch,hg_counts):
     """
     QC.1: Calculates the estimate of correct states from intermediate
     table and the total of intermediates found
     """ 
-    total = 0
-    correct_state = 0
-    for i in df_intermediate.values:           
-        tmp = df_haplogroup.loc[df_haplogroup["haplogroup"] == i[0]]    
-        if not tmp.empty:               
-            if "/" in i[1]:                
-                correct_state += len(tmp) 
-                total += len(tmp)                           
-            else:        
-                correct_state += np.sum(i[1] == tmp["state"])                                                
-                total += len(tmp)        
+    if branch is None or len(branch[0]) == 0:
+        return 0.0
+    names, expected = branch
+    counts = get_state_counts(hg_counts, names)
+    total = counts[:,2]
+    correct = np.where(expected == "A", counts[:,0], 0) + np.where(expected == "D", counts[:,1], 0)
+    correct = np.where(np.char.find(expected, "/") >= 0, total, correct)
+    total = int(np.sum(total))
+    correct_state = int(np.sum(correct))
     try:
         qc_one = round((correct_state / total),3)
     except ZeroDivisionError as error:
         qc_one =  0.0
     return qc_one
 
-def get_putative_hg_list(hg, df_haplogroup):
+def get_putative_hg_list(hg, hg_counts, tree, init_hg):
     """ 
     Removes all haplogroup but the main one
     Check if the preffix of all main haplogroup with D state by allowing one haplogroup that does not match 
@@ -117,19 +334,25 @@ def get_putative_hg_list(hg, df_haplogroup):
     QC.2
     Check if the same name of the main haplogroup appears as an Ancestral State and 
     save the number of count and calculate QC2
+    QC.2 and QC.3 of all candidates are derived from the per haplogroup counts
     """
     list_main_hg = sorted(list(set(hg)), reverse=False)
     hg_threshold = 0.75    
     dict_hg = {}
-    for putative_hg in list_main_hg:
-        total_qctwo = len(df_haplogroup.loc[df_haplogroup["haplogroup"] == putative_hg])
-        Ahg = np.sum("A" == df_haplogroup.loc[df_haplogroup["haplogroup"] == putative_hg]["state"])        
-        if total_qctwo == 0:
-            return dict_hg
-        else:            
-            qc_two = round((total_qctwo-Ahg)/total_qctwo,2)                
-            if qc_two >= hg_threshold:                        
-                dict_hg[putative_hg] = [qc_two,calc_score_three(df_haplogroup,putative_hg)]
+    counts = get_state_counts(hg_counts, list_main_hg)
+    total_qctwo = counts[:,2]
+    ## candidates after one without markers are not evaluated
+    without_markers = np.flatnonzero(total_qctwo == 0)
+    if len(without_markers) > 0:
+        list_main_hg = list_main_hg[:without_markers[0]]
+        counts = counts[:without_markers[0]]
+    total_qctwo = counts[:,2]
+    Ahg = counts[:,0]
+    list_qc_two = [round((total-a)/total,2) for total, a in zip(total_qctwo, Ahg)]
+    list_qc_three = calc_score_three(hg_counts, tree, init_hg, list_main_hg)
+    for putative_hg, qc_two, qc_three in zip(list_main_hg, list_qc_two, list_qc_three):
+        if qc_two >= hg_threshold:                        
+            dict_hg[putative_hg] = [qc_two,qc_three]
     return dict_hg
         
 def get_putative_hg(dict_hg):
@@ -151,7 +374,7 @@ def get_putative_hg(dict_hg):
     
     return putative_hg,qc_two    
     
-def calc_score_three(df_haplogroup,putative_hg):
+def calc_score_three(hg_counts,tree,init_hg,list_putative_hg):
     """
     QC.3
     Show both Ancestral and Derived states from the main haplogroup and check the preffix 
@@ -159,37 +382,28 @@ def calc_score_three(df_haplogroup,putative_hg):
     some Ancestral states which follows the pattern/preffix from the main haplogroup keep 
     the count of how many of these appear and this will give the total count. Substract 
     the ones found from the corrected and this will give the QC.3 score. 
+    Computed for all candidates at once from the per haplogroup counts of their ancestors.
     """
-    
-    
-    list_main_hg_all = []
-    list_hg_all = df_haplogroup["haplogroup"].values
-    for i in list_hg_all:    
-        if i.startswith(init_hg):
-            list_main_hg_all.append(i)
-    list_main_hg_all = sorted(list(set(list_main_hg_all)), reverse=True)
-    df_main_hg_all = df_haplogroup.loc[df_haplogroup["haplogroup"].isin(list_main_hg_all)]
-    df_main_hg_all = df_main_hg_all[["haplogroup","state","marker_name"]]
-    df_main_hg_all = df_main_hg_all.sort_values(by="haplogroup", ascending=False).values        
-    qc_three = 0.0
-    a_match = 0
-    total_match = 0
-    for putative_hg in [putative_hg]:
-        #print(putative_hg)
-        for i in df_main_hg_all:
-            tmp_hg = i[0].replace("~","")
-            if tmp_hg in putative_hg and tmp_hg != putative_hg:
-                total_match +=1        
-                if i[1] == "A":
-                    a_match += 1
+    n = len(list_putative_hg)
+    pairs = [(i, tmp_hg) for i, putative_hg in enumerate(list_putative_hg) 
+             for tmp_hg in tree.get_ancestors(putative_hg) if tmp_hg.startswith(init_hg)]
+    total_match = np.zeros(n)
+    a_match = np.zeros(n)
+    if pairs:
+        index, ancestors = zip(*pairs)
+        counts = get_state_counts(hg_counts, ancestors)
+        total_match = np.bincount(index, weights=counts[:,2], minlength=n)
+        a_match = np.bincount(index, weights=counts[:,0], minlength=n)
+    list_qc_three = []
+    for total, a in zip(total_match, a_match):
         try:
-            qc_three = round((total_match - a_match) / total_match,3)        
+            qc_three = round((int(total) - int(a)) / int(total),3)        
         except ZeroDivisionError as error:
             qc_three = 0.0
-    
-    return qc_three
+        list_qc_three.append(qc_three)
+    return list_qc_three
 
-def get_putative_ancenstral_hg(df_haplogroup, putative_hg):
+def get_putative_ancenstral_hg(haplogroup, state, marker_name, putative_hg, markers_by_hg, tree):
     
     """
     Haplogroup and marker name
@@ -198,124 +412,189 @@ def get_putative_ancenstral_hg(df_haplogroup, putative_hg):
 
     Could be that that there are more than one contain as a preffix from an ancestral state haplogroup. 
     Should report all of them only if there are different haplogroup name with the resolution
+    Returns the marker names of the reported haplogroups
     """    
     putative_ancestral_hg = []
     putative_hg = putative_hg.replace("~","")
-    df_putative_ancestral_hg = df_haplogroup.copy()
-    df_putative_ancestral_hg = df_putative_ancestral_hg[df_putative_ancestral_hg.haplogroup.str.startswith(putative_hg)]
-    df_putative_ancestral_hg['haplogroup'] = df_putative_ancestral_hg['haplogroup'].str.replace('~','') 
-    df_putative_ancestral_hg = df_putative_ancestral_hg[~df_putative_ancestral_hg.haplogroup.isin([putative_hg])]
-    df_putative_ancestral_hg = df_putative_ancestral_hg[df_putative_ancestral_hg.state == "A"]
-    df_putative_ancestral_hg = df_putative_ancestral_hg.sort_values(by=['haplogroup'])
-
-    for i in df_putative_ancestral_hg.index:    
+    rows = [markers_by_hg[i] for i in tree.get_descendants(putative_hg) if i in markers_by_hg]
+    rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+    rows = rows[state[rows] == "A"]
+    rows = rows[haplogroup[rows].argsort(kind="quicksort")]
+
+    for i in rows:    
         if putative_ancestral_hg == []:        
-            putative_ancestral_hg.append(df_putative_ancestral_hg.loc[i])                    
+            putative_ancestral_hg.append(i)                    
         else:
-            if putative_ancestral_hg[-1][3] not in df_putative_ancestral_hg.loc[i][3]:
-                putative_ancestral_hg.append(df_putative_ancestral_hg.loc[i])
-    if len(putative_ancestral_hg) > 0:
-        putative_ancestral_hg = pd.DataFrame(putative_ancestral_hg)
-    return putative_ancestral_hg
+            if haplogroup[putative_ancestral_hg[-1]] not in haplogroup[i]:
+                putative_ancestral_hg.append(i)
+    return list(marker_name[putative_ancestral_hg])
 
-if __name__ == "__main__":
+def predict_sample(df_haplogroup, out_name, path_hg_prediction_tables=None):
+    """
+    Predicts the haplogroup of one sample from its called markers, the table of 
+    a .out file or the one returned by extract_haplogroups in clean_tree.py. 
+    Returns the prediction record (columns of the .hg output), Hg is NA when 
+    the sample has to be checked manually
+    """
+    return predict_markers(df_haplogroup["marker_name"].values, df_haplogroup["haplogroup"].values, 
+                           df_haplogroup["state"].values, out_name, path_hg_prediction_tables)
+
+def predict_markers(marker_name, haplogroup, state, out_name, path_hg_prediction_tables=None):
+    """
+    predict_sample on the marker name, haplogroup and state columns of the 
+    called markers as arrays, only uses NumPy
+    """
+    home_source = os.path.dirname(os.path.realpath(__file__))
+    if path_hg_prediction_tables is None:
+        path_hg_prediction_tables = home_source+"/Hg_Prediction_tables/"
+    hg_intermediate = path_hg_prediction_tables
+    intermediates = set(load_prediction_tables(hg_intermediate).intermediates)
+
+    putative_hg = "NA"
+    ## sorted by haplogroup in the same (not stable) order as pandas sort_values
+    order = np.asarray(haplogroup, dtype=object).argsort(kind="quicksort")
+    haplogroup = np.array([str(i).replace('~', '') for i in np.asarray(haplogroup, dtype=object)[order]], dtype=object)
+    marker_name = np.asarray(marker_name, dtype=object)[order]
+    state = np.asarray(state, dtype=object)[order]
+    ## instance with only D state
+    derived = state == "D"
+            
+    ## Removes intermediate branches
+    is_intermediate = np.array([i in intermediates for i in haplogroup], dtype=bool)
+    hg = haplogroup[derived & ~is_intermediate]
     
-    print("\tY-Haplogroup Prediction")
+    init_hg = get_hg_root(hg)           
+    branch = get_intermediate_branch(init_hg,hg_intermediate)
     
-    args = get_arguments()                
+    hg_counts = count_states(haplogroup, state)
+    qc_one = calc_score_one(branch,hg_counts)                            
     
-    path_samples = args.Input
-    samples = check_if_folder(path_samples,'.out')                                                 
+    haplogroup_derived = haplogroup[derived]
+    haplogroup = haplogroup[~is_intermediate]
+    marker_name = marker_name[~is_intermediate]
+    state = state[~is_intermediate]
+    hg_counts = dict((i, hg_counts[i]) for i in hg_counts if i not in intermediates)
+    markers_by_hg = group_markers(haplogroup)
+    tree = HaplogroupTree(hg_counts)
     
-    out_file = args.Outputfile    
-        
-    home_source = os.path.dirname(os.path.realpath(__file__))
-    hg_intermediate = home_source+"/Hg_Prediction_tables/"    
-    intermediate_tree_table = hg_intermediate+"Intermediates.txt"        
+    hg = [i for i in haplogroup_derived if i.startswith(init_hg)]
     
-    h_flag = True            
-    log_output = []
-    for sample_name in samples:
-        #print(sample_name)
-        putative_hg = "NA"
-        out_name = sample_name.split("/")[-1]
-        out_name = out_name.split(".")[0]
-        
-        df_intermediate = pd.read_csv(intermediate_tree_table, header=None, engine='python')
-        intermediates = df_intermediate[0].values            
-        df_haplogroup = pd.read_csv(sample_name, sep="\t", engine='python')    
-        df_haplogroup = df_haplogroup.sort_values(by=['haplogroup'])        
-        df_haplogroup['haplogroup'] = df_haplogroup['haplogroup'].str.replace('~', '')        
-        ## instance with only D state
-        df_derived = df_haplogroup[df_haplogroup["state"] == "D"]
-                
-        df_tmp = df_derived
-        for hg in intermediates:    
-            ## Removes intermediate branches
-            df_tmp = df_tmp.drop(df_tmp[df_tmp.haplogroup == hg].index)
-        hg = df_tmp["haplogroup"].values                
-        
-        init_hg = get_hg_root(hg)           
-        df_intermediate = get_intermediate_branch(init_hg,hg_intermediate)
-        
-        qc_one = calc_score_one(df_intermediate,df_haplogroup)                            
-        
-        df_haplogroup = df_haplogroup[~df_haplogroup.haplogroup.isin(intermediates)]
-        
-        hg = df_derived[(df_derived.haplogroup.str.startswith(init_hg))].haplogroup.values        
-        
-        dict_hg = get_putative_hg_list(hg, df_haplogroup)                
-        hg_threshold = 0.75        
-        dict_key = sorted(dict_hg.keys(), reverse=True)
-        for i in dict_key:    
-            if (np.array(dict_hg[i][0]) >= hg_threshold) and np.array(dict_hg[i][1]) >= hg_threshold:
-                putative_hg = i
-                qc_two = dict_hg[i][0]
-                qc_three = dict_hg[i][1]                
-                break
-            
+    dict_hg = get_putative_hg_list(hg, hg_counts, tree, init_hg)                
+    hg_threshold = 0.75        
+    dict_key = sorted(dict_hg.keys(), reverse=True)
+    for i in dict_key:    
+        if (np.array(dict_hg[i][0]) >= hg_threshold) and np.array(dict_hg[i][1]) >= hg_threshold:
+            putative_hg = i
+            qc_two = dict_hg[i][0]
+            qc_three = dict_hg[i][1]                
+            break
+    
+    putative_ancestral_hg = get_putative_ancenstral_hg(haplogroup, state, marker_name, putative_hg, markers_by_hg, tree)        
+    ### Output        
+    marker_name = marker_name[markers_by_hg.get(putative_hg, [])]
+    if putative_hg == "NA":
+        output = [out_name, "NA", "NA", 0, 0, 0, 0]
+    else:
+        if len(marker_name) > 1:
+            out_hg = putative_hg[0]+"-"+marker_name[0]+"/etc"
+        elif len(marker_name) == 1:
+            out_hg = putative_hg[0]+"-"+marker_name[0]                        
+        if len(putative_ancestral_hg) > 0:
+            out_hg += "*(x"
+            for i in putative_ancestral_hg:        
+                out_hg += i+","                    
+            out_hg += ")"            
+            out_hg = list(out_hg)
+            del out_hg[-2]
+            out_hg = "".join(out_hg)
             
-        #putative_hg, qc_two = get_putative_hg(dict_hg)                        
-        #qc_three = calc_score_three(df_haplogroup,putative_hg)        
-        
-        putative_ancestral_hg = get_putative_ancenstral_hg(df_haplogroup, putative_hg )        
-        ### Output        
-        header = "Sample_name\tHg\tHg_marker\tQC-score\tQC-1\tQC-2\tQC-3"
-        marker_name = (df_haplogroup.loc[df_haplogroup["haplogroup"] == putative_hg]["marker_name"].values)
-        if putative_hg == "NA":
-            out_hg = "NA"            
-            output = "{}\tNA\tNA\t0\t0\t0\t0".format(out_name)
-            log_output.append(out_name)                        
+        qc_score = round((qc_one*qc_two*qc_three),3) 
+        if qc_score >= 0.7:                     
+            output = [out_name, putative_hg, out_hg, qc_score, qc_one, qc_two, qc_three]
         else:
-            if len(marker_name) > 1:
-                out_hg = putative_hg[0]+"-"+marker_name[0]+"/etc"
-            elif len(marker_name) == 1:
-                out_hg = putative_hg[0]+"-"+marker_name[0]                        
-            if len(putative_ancestral_hg) > 0:
-                out_hg += "*(x"
-                for i in putative_ancestral_hg.index:        
-                    out_hg += putative_ancestral_hg.loc[i]["marker_name"]+","                    
-                out_hg += ")"            
-                out_hg = list(out_hg)
-                del out_hg[-2]
-                out_hg = "".join(out_hg)
-                
-            qc_score = round((qc_one*qc_two*qc_three),3) 
-            if qc_score >= 0.7:                     
-                output = "{}\t{}\t{}\t{}\t{}\t{}\t{}".format(out_name,putative_hg,out_hg,qc_score,qc_one,qc_two,qc_three)                                                            
-            else:
-                log_output.append(out_name)                        
-                #output = "{}\tNA\tNA\t0\t0\t0\t0".format(out_name)                                
-                output = "{}\tNA\tNA\t{}\t{}\t{}\t{}".format(out_name,qc_score,qc_one,qc_two,qc_three)                                                            
-        w_file = open(out_file, "a")    
-        if h_flag:                
-            h_flag = False
-            w_file.write(header)            
-        w_file.write("\n")        
-        w_file.write(output)
-        w_file.close()        
+            output = [out_name, "NA", "NA", qc_score, qc_one, qc_two, qc_three]
+    return collections.OrderedDict(zip(prediction_columns, output))
+
+prediction_columns = ["Sample_name","Hg","Hg_marker","QC-score","QC-1","QC-2","QC-3"]
+
+def predict_file(sample_name, path_hg_prediction_tables=None):
+    """
+    Predicts the haplogroup of a .out file, the sample name is the file name 
+    up to the first dot
+    """
+    out_name = sample_name.split("/")[-1]
+    out_name = out_name.split(".")[0]
+    columns = read_out_columns(sample_name)
+    return predict_markers(columns["marker_name"], columns["haplogroup"], columns["state"], out_name, 
+                           path_hg_prediction_tables)
+
+def predict_files(samples, Jobs=1):
+    """
+    Yields the predictions of the .out files in the order of samples, with a 
+    pool of Jobs processes they are scored concurrently
+    """
+    if Jobs > 1 and len(samples) > 1:
+        home_source = os.path.dirname(os.path.realpath(__file__))
+        load_prediction_tables(home_source+"/Hg_Prediction_tables/") # shared with the worker processes
+        pool = multiprocessing.Pool(processes=min(Jobs, len(samples)))
+        try:
+            for prediction in pool.imap(predict_file, samples, chunksize=max(1, len(samples)//(Jobs*4))):
+                yield prediction
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for sample_name in samples:
+            yield predict_file(sample_name)
+
+def format_prediction(prediction, Format="hg"):
+    
+    if Format == "json":
+        return json.dumps(prediction)
+    return "\t".join("{}".format(prediction[i]) for i in prediction_columns)
+
+def write_predictions(predictions, out_file, Format="hg"):
+    """
+    Writes the prediction records to out_file in a single buffered write and 
+    lists the samples that need a manual check. The hg format is appended 
+    without a final new line, tsv and json overwrite out_file with one sample 
+    per line
+    """
+    header = "\t".join(prediction_columns)
+    log_output = []
+    lines = []
+    for prediction in predictions:
+        lines.append(format_prediction(prediction, Format))
+        if prediction["Hg"] == "NA":
+            log_output.append(prediction["Sample_name"])
+    if Format == "hg":
+        with open(out_file, "a") as w_file:
+            w_file.write("\n".join([header]+lines))
+    else:
+        if Format == "tsv":
+            lines.insert(0, header)
+        with open(out_file, "w") as w_file:
+            w_file.write("".join(i+"\n" for i in lines))
     if len(log_output) > 0:
         print("Warning: Following sample(s) showed discrepancies, please check output(s) manually: ")        
         print("\n".join(log_output))
+
+if __name__ == "__main__":
+    
+    print("\tY-Haplogroup Prediction")
+    
+    args = get_arguments()                
+    
+    path_samples = args.Input
+    out_file = args.Outputfile    
+    if path_samples.endswith(".cohort.npz"):
+        tables = read_cohort_table(path_samples)
+        predictions = [predict_sample(df, sample_name) for sample_name, df in tables.items()]
+        write_predictions(predictions, out_file, args.Format)
+    else:
+        samples = sorted(check_if_folder(path_samples,('.out','.out.npz')))
+        if samples:
+            write_predictions(predict_files(samples, args.Jobs), out_file, args.Format)
+        if args.Cohort and samples:
+            write_cohort_table([(i.split("/")[-1].split(".")[0], read_out_file(i)) for i in samples], args.Cohort)
     print("--- Clean tree 'Y-Haplogroup Extraction' finished... ---")
-    
\ No newline at end of file